@@ -0,0 +1,143 @@
+#
+# This file is part of BEAVr, https://github.com/theoryinpractice/beavr/, and is
+# Copyright (C) North Carolina State University, 2016. It is licensed under
+# the three-clause BSD license; see LICENSE.
+#
+
+import os
+import os.path as path
+import hashlib
+import shutil
+import tempfile
+from zipfile import BadZipfile
+
+import numpy as np
+
+
+class ArchiveCache(object):
+    """
+    Sidecar cache of parsed archive sections, stored as NumPy arrays
+
+    The cache for archive.zip lives in the directory archive.zip.beavr next to
+    it, with one .npz file per section.  The directory is tagged with a key
+    made from the archive's modification time, a hash of the name, size and
+    CRC-32 of every member, and the cache format version.  It is emptied
+    whenever the key no longer matches, so stale data is never returned.
+    """
+
+    suffix = '.beavr'
+    key_filename = 'key'
+    # Change this whenever the way a section is stored changes
+    version = 3
+
+    def __init__(self, directory, key):
+        """
+        Open the cache in the given directory, emptying it if it is stale
+        :param directory: directory holding the cached sections
+        :param key: key identifying the archive's current contents
+        """
+        self.directory = directory
+        self.key = key
+
+        if not path.isdir(directory):
+            os.mkdir(directory)
+        if self._stored_key() != key:
+            # The archive changed (or the cache is new), so start over
+            for filename in os.listdir(directory):
+                os.remove(path.join(directory, filename))
+            self._write(self.key_filename, lambda f: f.write(key))
+
+    @classmethod
+    def for_archive(cls, archive):
+        """
+        Open the cache for a ZipFile
+        :param archive: ZipFile object for an archive on disk
+        :returns: ArchiveCache, or None if the archive is not a file on disk
+                  or its cache directory cannot be created
+        """
+        filename = getattr(archive, 'filename', None)
+        if not filename or not path.isfile(filename):
+            return None
+        try:
+            return cls(filename + cls.suffix, cls.archive_key(archive))
+        except (IOError, OSError):
+            return None
+
+    @staticmethod
+    def archive_key(archive):
+        """
+        Compute the key identifying the contents of a ZipFile
+        :param archive: ZipFile object for an archive on disk
+        :returns: string that changes whenever the archive does
+        """
+        digest = hashlib.sha1()
+        for info in archive.infolist():
+            digest.update('{0}\0{1}\0{2}\0'.format(info.filename, info.CRC,
+                                                   info.file_size))
+        mtime = os.stat(archive.filename).st_mtime
+        return '{0} {1!r} {2}'.format(digest.hexdigest(), mtime,
+                                      ArchiveCache.version)
+
+    def filename(self, name):
+        """Name of the file a cached item is stored in"""
+        return path.join(self.directory, name)
+
+    def load(self, name):
+        """
+        Load a cached section
+        :param name: name of the section
+        :returns: dictionary of arrays, or None if the section isn't cached
+        """
+        try:
+            with np.load(self.filename(name + '.npz')) as data:
+                return dict((key, data[key]) for key in data.files)
+        except (IOError, OSError, ValueError, BadZipfile):
+            return None
+
+    def store(self, name, arrays):
+        """
+        Cache a section.  Failing to write the cache is not an error.
+        :param name: name of the section
+        :param arrays: dictionary of arrays to store
+        """
+        try:
+            self._write(name + '.npz', lambda f: np.savez(f, **arrays))
+        except (IOError, OSError):
+            pass
+
+    def extract(self, archive, member, name):
+        """
+        Extract an archive member into the cache, unless it already is
+        :param archive: ZipFile object for the archive
+        :param member: name of the member to extract
+        :param name: name to give the extracted file in the cache
+        :returns: name of the extracted file
+        """
+        filename = self.filename(name)
+        if not path.isfile(filename):
+            with archive.open(member) as member_file:
+                self._write(name, lambda f: shutil.copyfileobj(member_file, f))
+        return filename
+
+    def _stored_key(self):
+        """Read the key the cache was built for"""
+        try:
+            with open(self.filename(self.key_filename), 'rb') as key_file:
+                return key_file.read()
+        except (IOError, OSError):
+            return None
+
+    def _write(self, name, write):
+        """
+        Atomically replace a file in the cache directory
+        :param name: name of the file
+        :param write: function writing the file's contents to a file object
+        """
+        fd, tmp_name = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as tmp_file:
+                write(tmp_file)
+            os.rename(tmp_name, self.filename(name))
+        except:
+            os.remove(tmp_name)
+            raise
@@ -4,12 +4,20 @@
 # the three-clause BSD license; see LICENSE.
 #
 
+from abc import ABCMeta, abstractmethod
 from os.path import basename, splitext
 import collections
-
-from networkx import Graph
+import mmap
+import os
+import re
+from xml.parsers import expat
+import string
+
+from networkx import Graph, DiGraph
+import numpy as np
 import ast
-from beavr.dataloader import DataLoader
+from beavr.dataloader import DataLoader, lazy_section
+from beavr.layout import digraph_parents, tree_layouts
 
 class Factory(object):
     """ Wrapper allowing DataLoaderFactory to create a ConcussDataLoader """
@@ -25,19 +33,96 @@ class Factory(object):
 class ConcussDataLoader(DataLoader):
     """ Loads data provided by the CONCUSS pipeline """
 
-    def load(self):
+    sections = ('title_items', 'graph', 'pattern', 'colorings',
+                'big_component', 'table', 'tdd', 'tdd_layout',
+                'counts_per_colorset')
+
+    # DP tables larger than this many bytes are read from disk on demand
+    # instead of being parsed into memory
+    indexed_table_size = 64 * 2**20
+
+    @lazy_section
+    def title_items(self):
+        """Names of the graph, pattern and config used during the run"""
+        return self.load_title_items()
+
+    @lazy_section
+    def graph(self):
+        """The host graph"""
+        return self.cached('graph', self.load_graph, pack_graph, unpack_graph)
+
+    @lazy_section
+    def pattern(self):
+        """The pattern graph (motif)"""
+        return self.load_pattern()
+
+    @lazy_section
+    def colorings(self):
+        """Colorings of every step of the coloring stage"""
+        return self.cached('colorings', self.load_colorings,
+                           pack_colorings, unpack_colorings)
+
+    @lazy_section
+    def big_component(self):
+        """The largest component found by CONCUSS"""
+        return self.cached('big_component', self.load_big_component,
+                           pack_graph, unpack_graph)
+
+    @lazy_section
+    def table(self):
+        """The dynamic programming table of the count stage"""
+        if (self.cache is not None and
+                self.section_size('table') > self.indexed_table_size):
+            return self.load_indexed_dp_table()
+        return self.cached('table', self.load_dp_table,
+                           pack_dp_table, unpack_dp_table)
+
+    @lazy_section
+    def tdd(self):
+        """The treedepth decomposition of the big component"""
+        return self.cached('tdd', self.load_tdd, pack_tdd, unpack_tdd)
+
+    @lazy_section
+    def tdd_layout(self):
+        """Positions of the vertices of the treedepth decomposition"""
+        return self.cached('tdd_layout', self.load_tdd_layout, pack_layout,
+                           unpack_layout)
+
+    @lazy_section
+    def counts_per_colorset(self):
+        """Motif counts for each color set of the combine stage"""
+        return self.load_counts()
+
+    def section_members(self, name):
+        """
+        Names of the archive members a section is parsed from
+        :param name: name of the section
+        :returns: list of member names
+        """
+        if name == 'graph':
+            return [self.parser.get('graphs', 'graph')]
+        elif name == 'pattern':
+            return [self.parser.get('graphs', 'motif')]
+        elif name == 'colorings':
+            return self.coloring_files()
+        elif name == 'big_component':
+            return ['count/big_component.txt']
+        elif name == 'table':
+            return ['count/dp_table.txt']
+        elif name == 'tdd':
+            return ['count/tdd.txt']
+        elif name == 'counts_per_colorset':
+            return ['combine/counts_per_colorset.txt']
+        return []
+
+    def coloring_files(self):
         """
-        Load data from self.archive
-        :returns: loads and stores graph and colorings
+        Names of the coloring files under color/colorings/, in sorted order
         """
-        self.graph = self.load_graph()
-        self.pattern = self.load_pattern()
-        self.colorings = self.load_colorings()
-        self.big_component = self.load_big_component()
-        self.table = self.load_dp_table()
-        self.tdd = self.load_tdd()
-        self.counts_per_colorset= self.load_counts()
-        self.title_items = self.load_title_items()
+        files = self.archive.namelist()
+        files.sort()
+        return [f for f in files
+                if 'color/colorings/' == f[:16] and 'color/colorings/' != f]
 
     def load_title_items(self):
         """
@@ -144,96 +229,65 @@ class ConcussDataLoader(DataLoader):
 
         return tdd
 
+    def load_tdd_layout(self):
+        """
+        Lay the treedepth decomposition out radially, in the unit square
+
+        Returns: A dictionary mapping every vertex of the tdd to its position
+        """
+        return tree_layouts([digraph_parents(self.tdd)], 0)[0]
+
     def load_colorings(self):
         """
         Loads node color data from the data loader's archive
         coloring files must be under color/colorings/
-        :returns: list of colorings, where each coloring is list of RBG tuples
+        :returns: ColoringHistory with one coloring for each step
         """
-        colorings = []
-        files = self.archive.namelist()
-        files.sort()
-        nodes = 0
-        for f in files:
-            if 'color/colorings/' == f[:16] and 'color/colorings/' != f:
-                coloring = []
+        def steps():
+            for f in self.coloring_files():
                 with self.archive.open(f) as coloring_file:
-                    for line in coloring_file:
-                        line = line.strip()
-                        if ':' not in line:
-                            continue
-                        node, color = line.split(':')
-                        node = int(node)
-                        color = int(color)
-                        while len(coloring) <= node:
-                            coloring.append(0)
-                        coloring[node] = color
-                colorings.append(coloring)
-        if len(colorings) == 0:
-            colorings = [0]
-        return colorings
+                    yield parse_coloring(coloring_file.read())
+
+        return ColoringHistory.from_steps(steps())
 
     def load_dp_table(self):
         """
         Read the dynamic programming table provided by CONCUSS
 
-        Returns: $table$ - a dictionary which has the following format:
-        key: tuple of vertices
-        value: a list of lists each of which has the format:
+        Returns: $table$ - a DPTable, which maps tuples of vertices to lists
+        of lists each of which has the format:
                [count, k_pat_vertices, k_pat_boundary]
                where $count$ is an integer,
                      $k_pat_vertices$ is a list of vertices
                      $k_pat_boundary$ is a dictionary representing pi
                      where pi maps vertices in $k_pat_vertices$ to labels
         """
-
         dp_table_filename = "count/dp_table.txt"
-        table = {}
         with self.archive.open(dp_table_filename, 'r') as dp_table_file:
-            line = dp_table_file.readline().strip()
-            # Read until we reach eof
-            while line != "":
-                # Check if we have a new block
-                block = line[-1] == "{"
-                # If we have a block
-                if block:
-                    # Get the vertices
-                    vertex_list = [int(num) for num in line[1: line.find(']')].split(",")]
-                    # Read the first line in the block
-                    block_line = dp_table_file.readline().strip()
-                    # Make a list to store each entry in the block
-                    values = []
-                    # Loop until we reach end of block
-                    while block_line != "}":
-                        # For each line in the block make a list
-                        block_entry = []
-                        # Get the count, k_pat_vertices and boundary from that line
-                        count, k_pat_vertices, k_pat_boundary = tuple(block_line.split(";"))
-                        # Get terms in the boundary
-                        terms = []
-                        for term in k_pat_boundary.strip()[1:-1].split(","):
-                            if term != "":
-                                terms.append(term.strip())
-                        # Make a dictionary that represents pi
-                        pi = {}
-                        # Populate pi
-                        for term in terms:
-                            key_val = term.split(":")
-                            pi[int(key_val[0])] = int(key_val[1])
-                        # Add the count, k_pat_vertices and pi to our list
-                        block_entry.append(int(count))
-                        block_entry.append(ast.literal_eval(k_pat_vertices.strip()))
-                        block_entry.append(pi)
-                        # Add entry to values
-                        values.append(block_entry)
-                        # Go to the next line in the block
-                        block_line = dp_table_file.readline().strip()
-                    # Add $vertex_list$ as key and $values$ as value
-                    table[tuple(vertex_list)] = values
-                # Get the next line in the file
-                line = dp_table_file.readline().strip()
-        # return the DP table
-        return table
+            return DPTable(**parse_dp_table(dp_table_file.read()))
+
+    def load_indexed_dp_table(self):
+        """
+        Open the dynamic programming table for reading blocks on demand
+
+        dp_table.txt is extracted into the archive's cache, and the index of
+        its blocks is stored there too, so this is only slow the first time.
+        Returns: an IndexedDPTable
+        """
+        filename = self.cache.extract(self.archive, 'count/dp_table.txt',
+                                      'dp_table.txt')
+        index = self.cache.load('dp_index')
+        if index is None:
+            index = IndexedDPTable.make_index(filename)
+            self.cache.store('dp_index', index)
+        return IndexedDPTable(filename, **index)
+
+    def close(self):
+        """Close the archive and the DP table"""
+        with self.lock:
+            if self.is_loaded('table'):
+                self.table.close()
+            super(ConcussDataLoader, self).close()
 
     def get_graph_reader(self, ext):
         """
@@ -255,83 +309,660 @@ class ConcussDataLoader(DataLoader):
         else:
             raise Exception('Unsupported graph file format: {0}'.format(ext))
 
-# The following code is from CONCUSS, https://github.com/theoryinpractice/concuss/,
-# Copyright (C) North Carolina State University, 2015. It is licensed under
-# the three-clause BSD license; see LICENSE.
-class multidict(object):
+# The following functions convert parsed sections to and from the dictionaries
+# of arrays stored in the archive cache.
+def pack_graph(graph):
+    """Convert a graph to arrays of its nodes and edges"""
+    return {
+        'nodes': np.array(graph.nodes(), dtype=np.int64),
+        'edges': np.array(graph.edges(), dtype=np.int64).reshape(-1, 2)
+    }
+
+def unpack_graph(arrays):
+    """Build a graph from arrays of its nodes and edges"""
+    return graph_from_arrays(arrays['nodes'], arrays['edges'])
+
+def pack_tdd(tdd):
+    """Convert a treedepth decomposition to its vertex and parent arrays"""
+    edges = np.array(tdd.edges(), dtype=np.int64).reshape(-1, 2)
+    return {'vertices': edges[:, 0], 'parents': edges[:, 1]}
+
+def unpack_tdd(arrays):
+    """Build a treedepth decomposition from its vertex and parent arrays"""
+    tdd = DiGraph()
+    tdd.add_edges_from(zip(arrays['vertices'].tolist(),
+                           arrays['parents'].tolist()))
+    return tdd
+
+def pack_layout(layout):
+    """Convert a layout to arrays of its vertices and their positions"""
+    vertices = layout.keys()
+    return {
+        'vertices': np.array(vertices, dtype=np.int64),
+        'positions': np.array([layout[v] for v in vertices],
+                              dtype=float).reshape(-1, 2)
+    }
+
+def unpack_layout(arrays):
+    """Build a layout from arrays of its vertices and their positions"""
+    return dict(zip(arrays['vertices'].tolist(),
+                    map(tuple, arrays['positions'].tolist())))
+
+def pack_colorings(colorings):
+    """Convert a ColoringHistory to its base coloring and difference arrays"""
+    return {
+        'base': colorings.base,
+        'offsets': colorings.offsets,
+        'nodes': colorings.nodes,
+        'colors': colorings.colors
+    }
+
+def unpack_colorings(arrays):
+    """Build a ColoringHistory from its base coloring and difference arrays"""
+    return ColoringHistory(arrays['base'], arrays['offsets'], arrays['nodes'],
+                           arrays['colors'])
+
+def pack_dp_table(table):
+    """Get the flat arrays of a DPTable"""
+    if table.counts.dtype == object:
+        raise OverflowError('DP table counts do not fit in 64 bits')
+    return table.arrays()
+
+def unpack_dp_table(arrays):
+    """Build a DPTable from its flat arrays"""
+    return DPTable(**arrays)
+
+class BaseDPTable(object):
+    """
+    Base class for the dynamic programming table computed by CONCUSS
+
+    The table maps tuples of vertices to blocks of entries, with each entry in
+    the format [count, k_pat_vertices, pi] where pi maps boundary vertices in
+    k_pat_vertices to labels.  Subclasses decide how the entries are stored
+    and build the entries of a block when it is indexed.
+    """
+    __metaclass__ = ABCMeta
+
+    def __init__(self, key_offsets, key_vertices):
+        """
+        Map each vertex tuple to its block
+        :param key_offsets, key_vertices: the vertex tuple of block i is
+            key_vertices[key_offsets[i]:key_offsets[i+1]]
+        """
+        self.key_offsets = key_offsets
+        self.key_vertices = key_vertices
 
-    def __init__(self):
-        self.d = collections.defaultdict(list)
+        offsets = key_offsets.tolist()
+        vertices = key_vertices.tolist()
+        self.blocks = dict((tuple(vertices[start:end]), block)
+                           for block, (start, end) in
+                           enumerate(zip(offsets, offsets[1:])))
 
-    def __getitem__(self, key):
-        if len(self.d[key]) == 1:
-            return self.d[key][0]
-        return self.d[key]
+    @abstractmethod
+    def block_entries(self, block):
+        """Build the list of entries of the block with the given index"""
 
-    def __setitem__(self, key, value):
-        if value is None:
-            self.d[key] = []
-        else:
-            self.d[key].append(value)
+    def block_key(self, block):
+        """Get the vertex tuple of the block with the given index"""
+        return tuple(self.key_vertices[self.key_offsets[block]:
+                                       self.key_offsets[block + 1]].tolist())
+
+    def __getitem__(self, vertices):
+        return self.block_entries(self.blocks[tuple(vertices)])
+
+    def __contains__(self, vertices):
+        return tuple(vertices) in self.blocks
+
+    def __len__(self):
+        return len(self.blocks)
 
     def __iter__(self):
-        return iter(self.d)
+        return iter(self.blocks)
+
+    def keys(self):
+        return self.blocks.keys()
+
+    def iterkeys(self):
+        return self.blocks.iterkeys()
+
+    def iteritems(self):
+        for vertices in self.blocks:
+            yield vertices, self[vertices]
+
+    def close(self):
+        """Release any resources held by the table"""
+
+
+class DPTable(BaseDPTable):
+    """
+    The dynamic programming table, stored in memory as flat arrays
+
+    Instead of millions of small Python objects, each variable-length list is
+    stored as one array of values and one array of offsets, so that the
+    values for item i are values[offsets[i]:offsets[i+1]].  The arrays are:
+        key_offsets, key_vertices -- the vertex tuple of each block
+        entry_offsets -- the entries belonging to each block
+        counts -- the count of each entry
+        pattern_offsets, pattern_vertices -- the k-pattern vertices of each
+                                             entry
+        boundary_offsets, boundary_vertices, boundary_labels -- the boundary
+                                                                of each entry
+    """
+
+    array_names = ('key_offsets', 'key_vertices', 'entry_offsets', 'counts',
+                   'pattern_offsets', 'pattern_vertices', 'boundary_offsets',
+                   'boundary_vertices', 'boundary_labels')
+
+    def __init__(self, key_offsets, key_vertices, entry_offsets, counts,
+                 pattern_offsets, pattern_vertices, boundary_offsets,
+                 boundary_vertices, boundary_labels):
+        """Create a DPTable from its flat arrays"""
+        super(DPTable, self).__init__(key_offsets, key_vertices)
+        self.entry_offsets = entry_offsets
+        self.counts = counts
+        self.pattern_offsets = pattern_offsets
+        self.pattern_vertices = pattern_vertices
+        self.boundary_offsets = boundary_offsets
+        self.boundary_vertices = boundary_vertices
+        self.boundary_labels = boundary_labels
+
+    def arrays(self):
+        """Get a dictionary of the table's flat arrays"""
+        return dict((name, getattr(self, name)) for name in self.array_names)
+
+    def entry(self, index):
+        """Build the entry with the given index"""
+        patterns = slice(self.pattern_offsets[index],
+                         self.pattern_offsets[index + 1])
+        boundary = slice(self.boundary_offsets[index],
+                         self.boundary_offsets[index + 1])
+        return [int(self.counts[index]),
+                self.pattern_vertices[patterns].tolist(),
+                dict(zip(self.boundary_vertices[boundary].tolist(),
+                         self.boundary_labels[boundary].tolist()))]
+
+    def block_entries(self, block):
+        """Build the list of entries of the block with the given index"""
+        return [self.entry(index) for index in
+                range(self.entry_offsets[block], self.entry_offsets[block + 1])]
+
+    def entry_block(self, index):
+        """Find the index of the block the entry with the given index is in"""
+        return int(np.searchsorted(self.entry_offsets, index, 'right')) - 1
+
+    def max_boundary_labels(self):
+        """
+        Find the largest boundary label of every entry
+        :returns: array of the largest label of each entry, or -1 for entries
+                  with an empty boundary
+        """
+        starts = self.boundary_offsets[:-1]
+        nonempty = self.boundary_offsets[1:] > starts
+        max_labels = np.full(len(starts), -1, dtype=np.int64)
+        # Empty boundaries add no labels, so each reduced slice runs over
+        # exactly one entry's labels
+        if nonempty.any():
+            max_labels[nonempty] = np.maximum.reduceat(self.boundary_labels,
+                                                       starts[nonempty])
+        return max_labels
+
+
+class IndexedDPTable(BaseDPTable):
+    """
+    The dynamic programming table, read one block at a time from disk
+
+    dp_table.txt is memory-mapped, and only the byte offset of each block is
+    kept in memory.  Indexing the table parses just the requested block, so
+    tables much larger than memory can still be sampled.
+    """
+
+    # Header of a block, e.g. "[3, 33] {"
+    header = re.compile(r'^\[[^\]\n]*\][ \t]*\{', re.M)
+
+    def __init__(self, filename, key_offsets, key_vertices, block_starts):
+        """
+        Open a DP table file using an index made by make_index
+        :param filename: name of the extracted dp_table.txt
+        :param key_offsets, key_vertices: the vertex tuple of each block
+        :param block_starts: byte offset of each block's header, followed by
+                             the size of the file
+        """
+        super(IndexedDPTable, self).__init__(key_offsets, key_vertices)
+        self.block_starts = block_starts
 
-    def __contains__(self, key):
-        return key in self.d
+        with open(filename, 'rb') as table_file:
+            if block_starts[-1] > 0:
+                self.map = mmap.mmap(table_file.fileno(), 0,
+                                     access=mmap.ACCESS_READ)
+            else:
+                # Empty files can't be mapped
+                self.map = ''
 
-    def __repr__(self):
-        return str(self)
+    @classmethod
+    def make_index(cls, filename):
+        """
+        Find the vertex tuple and byte offset of every block in a file
+        :param filename: name of the extracted dp_table.txt
+        :returns: dictionary of the arrays needed to create an IndexedDPTable
+        """
+        with open(filename, 'rb') as table_file:
+            size = os.fstat(table_file.fileno()).st_size
+            if size == 0:
+                headers, starts = (), ()
+            else:
+                table_map = mmap.mmap(table_file.fileno(), 0,
+                                      access=mmap.ACCESS_READ)
+                try:
+                    matches = [(match.start(), match.group())
+                               for match in cls.header.finditer(table_map)]
+                finally:
+                    table_map.close()
+                starts, headers = zip(*matches) or ((), ())
+        # Parse all the headers at once as a table of empty blocks
+        keys = parse_dp_table('\n'.join(headers))
+        return {
+            'key_offsets': keys['key_offsets'],
+            'key_vertices': keys['key_vertices'],
+            'block_starts': np.array(starts + (size,), dtype=np.int64)
+        }
+
+    def block_entries(self, block):
+        """Read and parse the block with the given index"""
+        text = self.map[self.block_starts[block]:self.block_starts[block + 1]]
+        return DPTable(**parse_dp_table(text)).block_entries(0)
+
+    def close(self):
+        """Unmap the table file"""
+        if self.map:
+            self.map.close()
+
+
+class ColoringHistory(object):
+    """
+    The colorings of every step of the coloring stage
+
+    Consecutive colorings differ in only a few vertices, so only the first
+    coloring is stored in full.  Every later step is stored as the vertices
+    whose color changed and their new colors, and the full coloring of a step
+    is rebuilt when it is indexed.  The most recently used colorings are kept
+    so stepping back and forth through them is instant.
+
+    Indexing gives a read-only int32 array mapping vertices to colors.
+    """
+
+    # Number of rebuilt colorings to keep
+    cache_size = 8
+
+    def __init__(self, base, offsets, nodes, colors):
+        """
+        Create a ColoringHistory from its arrays
+        :param base: coloring of step 0
+        :param offsets: array of length steps + 1; the changes made by step i
+                        are nodes[offsets[i]:offsets[i+1]] and the colors at
+                        the same positions.  Vertices past the end of the base
+                        coloring start with color 0.
+        :param nodes: vertices changed by each step
+        :param colors: new colors of the changed vertices
+        """
+        self.base = base
+        self.offsets = offsets
+        self.nodes = nodes
+        self.colors = colors
+        self.n_nodes = max(len(base), nodes.max() + 1 if len(nodes) else 0)
 
-    def __len__(self):
-        return len(self.d)
+        # Most recently used colorings, oldest first
+        self.materialized = collections.OrderedDict()
 
-    def __str__(self):
-        res = "{"
-        for key in self:
-            if len(self.d[key]) == 1:
-                res += "{0}: {1}, ".format(key, self.d[key][0])
+    @classmethod
+    def from_steps(cls, steps):
+        """
+        Create a ColoringHistory from the parsed coloring of every step
+        :param steps: iterable of (nodes, colors) array pairs; vertices not in
+                      a step's nodes have color 0 in that step
+        """
+        base = None
+        current = np.zeros(0, dtype=np.int32)
+        lengths = [0]
+        nodes, colors = [], []
+        for step_nodes, step_colors in steps:
+            n_nodes = max(len(current),
+                          step_nodes.max() + 1 if len(step_nodes) else 0)
+            coloring = np.zeros(n_nodes, dtype=np.int32)
+            coloring[step_nodes] = step_colors
+            if base is None:
+                base = coloring
             else:
-                res += "{0}: {1}, ".format(key, self.d[key])
-        if len(self) != 0:
-            res = res[:-2]
-        res += "}"
-        return res
+                previous = np.zeros(n_nodes, dtype=np.int32)
+                previous[:len(current)] = current
+                changed = np.flatnonzero(coloring != previous)
+                nodes.append(changed)
+                colors.append(coloring[changed])
+                lengths.append(len(changed))
+            current = coloring
+
+        if base is None:
+            # No coloring files, so there is one empty coloring
+            base = current
+        return cls(base, np.cumsum([0] + lengths, dtype=np.int64),
+                   np.concatenate(nodes or [[]]).astype(np.int64),
+                   np.concatenate(colors or [[]]).astype(np.int32))
 
-def read_gexf(graph_file):
-    from BeautifulSoup import BeautifulSoup as Soup
-    soup = Soup(graph_file.read())
-    graph = Graph()
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    @property
+    def shape(self):
+        """Shape (steps, nodes) of the colorings as a 2-D array"""
+        return (len(self), self.n_nodes)
+
+    def __getitem__(self, index):
+        """Get the coloring after the given step"""
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('coloring step out of range')
+
+        if index in self.materialized:
+            coloring = self.materialized.pop(index)
+        else:
+            # Start from the closest earlier coloring we already have
+            start = max([i for i in self.materialized if i < index] or [0])
+            if start in self.materialized:
+                coloring = self.materialized[start].copy()
+            else:
+                coloring = np.zeros(self.n_nodes, dtype=np.int32)
+                coloring[:len(self.base)] = self.base
+            for step in range(start + 1, index + 1):
+                changes = slice(self.offsets[step], self.offsets[step + 1])
+                coloring[self.nodes[changes]] = self.colors[changes]
+            coloring.setflags(write=False)
+            if len(self.materialized) >= self.cache_size:
+                self.materialized.popitem(last=False)
+        self.materialized[index] = coloring
+        return coloring
 
-    for edge in soup.findAll("edge"):
-        source = int(edge['source'])
-        target = int(edge['target'])
-        graph.add_edge(source, target)
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+def parse_coloring(text):
+    """
+    Parse the contents of a coloring file in one pass
+    :param text: lines of the form "node: color"
+    :returns: arrays of nodes and of their colors
+    """
+    values = np.fromstring(text.replace(':', ' '), dtype=np.int32, sep=' ')
+    if len(values) != 2 * text.count(':'):
+        # There is something other than "node: color" lines in the file, so
+        # only keep the lines with a colon
+        text = '\n'.join(line for line in text.splitlines() if ':' in line)
+        values = np.fromstring(text.replace(':', ' '), dtype=np.int32, sep=' ')
+    values = values.reshape(-1, 2)
+    return values[:, 0], values[:, 1]
+
+def parse_edgelist(text):
+    """
+    Parse the contents of an edge list file in one pass
+    :param text: lines of the form "source target", possibly with comment
+                 lines starting with "#" and blank lines
+    :returns: array of shape (m, 2) of edge endpoints
+    """
+    values = np.fromstring(text, dtype=np.int64, sep=' ')
+    lines = text.count('\n') + (not text.endswith('\n'))
+    if len(values) != 2 * lines:
+        # There are blank lines, comments or something else in the file, so
+        # only keep the lines with an edge on them
+        edge_lines = [line for line in text.splitlines()
+                      if line.strip() and not line.lstrip().startswith('#')]
+        values = np.fromstring('\n'.join(edge_lines), dtype=np.int64,
+                               sep=' ')
+        if len(values) != 2 * len(edge_lines):
+            raise ValueError('Malformed edge list')
+    return values.reshape(-1, 2)
+
+# Separators in dp_table.txt that carry no information
+dp_table_separators = string.maketrans('[},:;', '     ')
+
+def parse_dp_table(text):
+    """
+    Parse the contents of dp_table.txt in bulk
+
+    The file is turned into one stream of integers: the vertices of a block's
+    header, then for each entry its count, k-pattern vertices and boundary
+    vertex/label pairs.  Every list ends with -1 (from "]") and every header
+    is followed by -2 (from "{"), since neither can be a vertex, label or
+    count.  The stream is then split into lists with array operations.
+    :param text: contents of the file
+    :returns: dictionary of the arrays needed to create a DPTable
+    """
+    values = np.fromstring(text.replace(']', ' -1 ').replace('{', ' -2 ')
+                           .translate(dp_table_separators),
+                           dtype=np.int64, sep=' ')
+
+    # Split the stream into lists, and find which lists are block headers
+    ends = np.flatnonzero(values == -1)
+    is_header = values[np.minimum(ends + 1, len(values) - 1)] == -2
+    values = values[values != -2]
+    ends = np.flatnonzero(values == -1)
+    starts = np.append(0, ends[:-1] + 1)
+    lengths = ends - starts
+    index = np.arange(len(ends))
+
+    # After a header, lists alternate between a count followed by k-pattern
+    # vertices, and boundary pairs.  Ignore any lists before the first block.
+    headers = np.flatnonzero(is_header)
+    first = headers[0] if len(headers) else len(ends)
+    position = index - np.maximum.accumulate(np.where(is_header, index, -1))
+    is_pattern = (position % 2 == 1) & (index > first)
+    is_boundary = (position % 2 == 0) & ~is_header & (index > first)
+    if is_pattern.sum() != is_boundary.sum():
+        raise ValueError('Malformed DP table')
+
+    # Find the list each value belongs to; values after the last list belong
+    # to none of them
+    is_end = values == -1
+    list_of_value = np.cumsum(is_end) - is_end
+    count_positions = starts[is_pattern]
+    is_value = ~is_end
+    is_value[count_positions] = False
+
+    def flatten(is_list, lengths):
+        """Get the values and offsets of the selected lists"""
+        flat = values[is_value & np.append(is_list, False)[list_of_value]]
+        offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        return flat, offsets
+
+    key_vertices, key_offsets = flatten(is_header, lengths[is_header])
+    pattern_vertices, pattern_offsets = flatten(is_pattern,
+                                                lengths[is_pattern] - 1)
+    boundary_values, boundary_offsets = flatten(is_boundary,
+                                                lengths[is_boundary] // 2)
+    boundary_values = boundary_values.reshape(-1, 2)
+
+    # Block i's entries are the ones between headers i and i+1
+    block_of_entry = np.cumsum(is_header)[is_pattern] - 1
+    entry_offsets = np.zeros(len(headers) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(block_of_entry, minlength=len(headers)),
+              out=entry_offsets[1:])
+
+    counts = values[count_positions]
+    if (counts == np.iinfo(np.int64).max).any():
+        # Some counts didn't fit in 64 bits, so keep them as Python integers
+        counts = np.array([int(count) for count in
+                           re.findall(r'^\s*(\d+)\s*;', text, re.M)],
+                          dtype=object)
+
+    return {
+        'key_offsets': key_offsets,
+        'key_vertices': key_vertices,
+        'entry_offsets': entry_offsets,
+        'counts': counts,
+        'pattern_offsets': pattern_offsets,
+        'pattern_vertices': pattern_vertices,
+        'boundary_offsets': boundary_offsets,
+        'boundary_vertices': boundary_values[:, 0].copy(),
+        'boundary_labels': boundary_values[:, 1].copy()
+    }
+
+def graph_from_arrays(nodes, edges):
+    """
+    Build a graph in bulk
+    :param nodes: array of node ids
+    :param edges: array of shape (m, 2) of edge endpoints
+    :returns: graph
+    """
+    graph = Graph()
+    graph.add_nodes_from(nodes.tolist())
+    graph.add_edges_from(edges.tolist())
     return graph
 
+# A string in a GML file
+gml_string = re.compile(r'"[^"]*"')
+
+def read_gexf(graph_file):
+    return read_xml_edges(graph_file)
+
 def read_graphml(graph_file):
-    from BeautifulSoup import BeautifulSoup as Soup
-    soup = Soup(graph_file.read())
-    graph = Graph()
+    return read_xml_edges(graph_file)
 
-    for edge in soup.findAll("edge"):
-        source = int(edge['source'])
-        target = int(edge['target'])
-        graph.add_edge(source, target)
-    return graph
-    
-def read_gml(graph_file):
+def read_xml_edges(graph_file, batch_size=2**16):
+    """
+    Read the edges of a GEXF or GraphML graph in one streaming pass
+
+    The file is parsed with expat without building a tree, so memory use
+    doesn't grow with the size of the file, and edges are added to the graph
+    in batches.
+    """
     graph = Graph()
+    edges = []
+
+    def start_element(name, attributes):
+        # Ignore any namespace prefix
+        if name.rpartition(':')[2].lower() == 'edge':
+            edges.append((int(attributes['source']),
+                          int(attributes['target'])))
+            if len(edges) == batch_size:
+                graph.add_edges_from(edges)
+                del edges[:]
+
+    parser = expat.ParserCreate()
+    parser.StartElementHandler = start_element
+    parser.ParseFile(graph_file)
+    graph.add_edges_from(edges)
+    return graph
 
-    data = read_gml_data(graph_file)
-    for n in data['graph']['node']:
-        graph.add_node(int(n['id']))
+def read_gml(graph_file):
+    """
+    Read a GML graph in one streaming pass
+
+    Only node ids and edge endpoints are kept.  The file is read in large
+    chunks, each chunk is split into an array of tokens, and the ids and
+    endpoints are picked out with array operations, so there is no Python
+    code run per token.  The graph is then built from them in bulk.
+    """
+    nodes = []
+    edges = []
+    # Tokens of blocks that continue into the next chunk
+    tokens = []
+    depth = 0
+    for chunk in gml_chunks(graph_file):
+        tokens = np.array(tokens + gml_string.sub('""', chunk)
+                          .replace('[', ' [ ').replace(']', ' ] ').split(),
+                          dtype=str)
+        depth, tokens = read_gml_tokens(tokens, depth, nodes, edges, False)
+    read_gml_tokens(np.array(tokens, dtype=str), depth, nodes, edges, True)
+
+    return graph_from_arrays(np.concatenate(nodes or [[]]).astype(np.int64),
+                             np.concatenate(edges or [[]])
+                             .astype(np.int64).reshape(-1, 2))
+
+def read_gml_tokens(tokens, depth, nodes, edges, last):
+    """
+    Find node ids and edge endpoints in an array of GML tokens
+    :param tokens: array of tokens, with strings emptied
+    :param depth: nesting depth at the first token
+    :param nodes: list to append an array of node ids to
+    :param edges: list to append an array of edge endpoints to
+    :param last: whether these are the last tokens of the file
+    :returns: depth after the tokens that were read, and list of tokens left
+              unread because the node or edge they belong to isn't complete
+    """
+    is_open = tokens == '['
+    is_close = tokens == ']'
+    # Depth of each token; a block's brackets count as inside its parent
+    # and inside the block, respectively
+    token_depth = (depth + np.cumsum(is_open) - is_open
+                   - np.cumsum(is_close) + is_close)
+
+    # Only read up to the end of the last complete node or edge
+    if last:
+        end = len(tokens)
+    else:
+        block_ends = np.flatnonzero(is_close & (token_depth == 2))
+        end = block_ends[-1] + 1 if len(block_ends) else 0
+    rest = tokens[end:].tolist()
+    tokens = tokens[:end]
+    is_open = is_open[:end]
+    token_depth = token_depth[:end]
+    if end > 0:
+        # We stopped just after a node or edge, inside the graph
+        depth = 1
+
+    # Find the node or edge block containing each token
+    block_starts = np.flatnonzero(is_open & (token_depth == 1))
+    block_names = tokens[np.maximum(block_starts - 1, 0)]
+    # Keys and values in nodes and edges alternate, apart from names of
+    # nested blocks
+    is_item = (token_depth == 2) & ~is_open & (tokens != ']')
+    is_item[:-1] &= ~is_open[1:]
+    items = np.flatnonzero(is_item)
+    keys, values = tokens[items[0::2]], tokens[items[1::2]]
+    blocks = np.searchsorted(block_starts, items[0::2]) - 1
+    names = block_names[blocks]
+
+    nodes.append(values[(names == 'node') & (keys == 'id')])
+    is_edge = names == 'edge'
+    is_source = is_edge & (keys == 'source')
+    is_target = is_edge & (keys == 'target')
+    # Skip any edges missing an endpoint
+    has_both = np.intersect1d(blocks[is_source], blocks[is_target])
+    is_source &= np.in1d(blocks, has_both)
+    is_target &= np.in1d(blocks, has_both)
+    edges.append(np.column_stack((values[is_source], values[is_target])))
+
+    return depth, rest
+
+def gml_chunks(graph_file, size=2**20):
+    """
+    Read a GML file in pieces that each end just after a closing bracket
+    outside of any string, so that no token is split between pieces
+    """
+    rest = ''
+    while True:
+        data = graph_file.read(size)
+        if not data:
+            break
+        data = rest + data
+        end = data.rfind(']') + 1
+        while end > 0 and data.count('"', 0, end) % 2 == 1:
+            end = data.rfind(']', 0, end - 1) + 1
+        rest = data[end:]
+        if end > 0:
+            yield data[:end]
+    if rest:
+        yield rest
 
-    for e in data['graph']['edge']:
-        graph.add_edge(int(e['source']), int(e['target']))
+def read_edgelist(graph_file):
+    """
+    Read a graph stored as one "source target" line per edge, in bulk
+    """
+    edges = parse_edgelist(graph_file.read())
+    return graph_from_arrays(np.empty(0, dtype=np.int64), edges)
 
-    return graph
-    
+# The following code is from CONCUSS, https://github.com/theoryinpractice/concuss/,
+# Copyright (C) North Carolina State University, 2015. It is licensed under
+# the three-clause BSD license; see LICENSE.
 def read_leda(graph_file):
     graph = Graph()
 
@@ -356,66 +987,6 @@ def read_leda(graph_file):
 
     return graph
     
-def read_edgelist(graph_file):
-    graph = Graph()
-    for line in graph_file:
-        line = line.strip()
-        if line[0] == '#':
-            continue
-        source, target = line.split()
-        s = int(source)
-        t = int(target)
-
-        graph.add_edge(s, t)
-
-    return graph
-
-def read_gml_data(graph_file):
-    stream = []
-    for l in graph_file:
-        l = l.strip()
-        if len(l) == 0:
-            continue
-        fields = l.split(" ")
-        token = lambda: None  # Inline object
-        token.name = None
-        if len(fields) == 1 or (len(fields) == 2 and fields[1] == '['):
-            v = fields[0]
-            if v == "[":
-                token.type = "BLOCK_START"
-            elif v == "]":
-                token.type = "BLOCK_END"
-            else:
-                token.type = "BLOCK_NAME"
-                token.name = v
-        else:
-            token.type = "FIELD"
-            token.name = fields[0]
-            token.value = "".join(fields[1:])
-        stream.append(token)
-
-    data = multidict()
-    data[0] = 0
-    stack = [data]
-    del data.d[0]
-    for token in stream:
-        current = stack[-1]
-        if token.type == "BLOCK_NAME":
-            # Start new data block
-            block = multidict()
-            block[0] = 0
-            label = token.name
-            current[label] = block
-            stack.append(block)
-            del block.d[0]
-        elif token.type == "BLOCK_START":
-            pass
-        elif token.type == "BLOCK_END":
-            stack.pop()
-        elif token.type == "FIELD":
-            current[token.name] = token.value
-    return data
-
 def skip_lines(fileit, num):
     skipped = 0
     while skipped < num:
@@ -10,6 +10,7 @@ import os.path as path
 
 import wx
 from wx.lib.scrolledpanel import ScrolledPanel
+import numpy as np
 from numpy import random, fromstring, uint8
 import networkx as nx
 import matplotlib
@@ -18,7 +19,7 @@ import matplotlib.pyplot as plt
 from matplotlib.figure import Figure
 
 from beavr.stageinterface import StageInterface, StageVisualizer, MatplotlibVisualizer
-from beavr.concuss.visualizerbackend import DecompositionGenerator, CombineSetGenerator, CountGenerator
+from beavr.concuss.visualizerbackend import DecompositionGenerator, DecompositionPrefetcher, CombineSetGenerator, CountGenerator
 from beavr.util import load_palette, resource_filename, map_coloring, map_colorings, choose
 
 class ColorInterface(StageInterface):
@@ -26,6 +27,9 @@ class ColorInterface(StageInterface):
 
     name = "Color"
 
+    # DataLoader sections needed to build this interface
+    sections = ('graph', 'colorings')
+
     def __init__(self, parent):
         """Fill the empty GUI elements with coloring-specific widgets"""
         super(ColorInterface, self).__init__(parent)
@@ -78,6 +82,9 @@ class DecomposeInterface(StageInterface):
 
     name = "Decompose"
 
+    # DataLoader sections needed to build this interface
+    sections = ('graph', 'pattern', 'colorings')
+
     def __init__(self, parent, graph, pattern, coloring):
         """Fill the empty GUI elements with decomposition-specific widgets"""
         super(DecomposeInterface, self).__init__(parent)
@@ -141,7 +148,12 @@ class CountInterface(StageInterface):
 
     name = "Count"
 
-    def __init__(self, parent, graph, pattern, tdd, dptable, coloring):
+    # DataLoader sections needed to build this interface
+    sections = ('big_component', 'pattern', 'tdd', 'tdd_layout', 'table',
+                'colorings')
+
+    def __init__(self, parent, graph, pattern, tdd, dptable, coloring,
+                 tdd_layout=None):
         """Fill the empty GUI elements with counting-specific widgets"""
         super(CountInterface, self).__init__(parent)
 
@@ -153,7 +165,8 @@ class CountInterface(StageInterface):
 
         self.tb.Realize()
 
-        vis = CountVisualizer(self, graph, pattern, tdd, dptable, coloring)
+        vis = CountVisualizer(self, graph, pattern, tdd, dptable, coloring,
+                              tdd_layout=tdd_layout)
         self.set_visualization(vis)
 
     def on_random(self, e):
@@ -167,6 +180,9 @@ class CombineInterface(wx.Panel):
 
     name = "Combine"
 
+    # DataLoader sections needed to build this interface
+    sections = ('pattern', 'colorings', 'counts_per_colorset')
+
     def __init__(self, parent, pattern, colorings, colors, min_size, counts_per_colorset):
         """Fill the empty GUI elements with combination-specific widgets"""
         super(CombineInterface, self).__init__(parent)
@@ -343,7 +359,6 @@ class ColorVisualizer(MatplotlibVisualizer):
         self.graph = graph
         self.palette = load_palette(palette_name)
         self.colorings = colorings
-        self.mapped_colorings = map_colorings(self.palette, self.colorings)
         self.graph_layout(0)
 
         self.update_graph_display(reset_zoom=True)
@@ -366,9 +381,11 @@ class ColorVisualizer(MatplotlibVisualizer):
             self.axes.set_xlim(cur_xlim)
             self.axes.set_ylim(cur_ylim)
         self.axes.set_axis_bgcolor((.8,.8,.8))
+        # Only map the displayed coloring, since there may be thousands
+        mapped_coloring = map_coloring(self.palette,
+                                       self.colorings[self.coloring_index])
         nx.draw_networkx(self.graph, self.layout, ax=self.axes,
-                         node_color=self.mapped_colorings[self.coloring_index],
-                         with_labels=False)
+                         node_color=mapped_coloring, with_labels=False)
         # Redraw
         self.canvas.Refresh()
 
@@ -376,6 +393,11 @@ class ColorVisualizer(MatplotlibVisualizer):
 class DecomposeVisualizer(MatplotlibVisualizer):
     """The visualization for the CONCUSS decompose stage"""
 
+    # When the components of a color set have more vertices than this, each
+    # isomorphism class is shown as a single glyph, and components are only
+    # drawn in full once zoomed in to few enough vertices
+    detail_threshold = 2000
+
     def __init__(self, parent, p):
         """Create the CONCUSS decompose visualization"""
         super(DecomposeVisualizer, self).__init__(parent)
@@ -383,8 +405,28 @@ class DecomposeVisualizer(MatplotlibVisualizer):
         self.parent = parent
         self.graph = nx.Graph()
         self.p = p
+        self.prefetcher = None
+
+        # Decomposition of the color set on display
+        self.cc_list = []
+        self.occurrences = []
+        self.layouts = []
+        # Bounding box (x_min, y_min, x_max, y_max) and number of vertices
+        # of each component
+        self.boxes = np.zeros((0, 4))
+        self.sizes = np.zeros(0, dtype=int)
+        # Whether glyphs are shown instead of components, and the set of
+        # components drawn in full anyway
+        self.summarized = False
+        self.detailed = frozenset()
+        self.histogram_axes = None
 
         self.canvas.Bind(wx.EVT_PAINT, self.on_paint)
+        self.Bind(wx.EVT_WINDOW_DESTROY, self.on_destroy)
+        # Decide which components to draw in full once zooming or panning
+        # has changed the view, outside of the event that changed it
+        self.canvas.mpl_connect('scroll_event', self.on_view_changed)
+        self.canvas.mpl_connect('button_release_event', self.on_view_changed)
 
     def on_paint(self, evt):
         """Draw a legend in the top-left corner of the graph display"""
@@ -453,26 +495,135 @@ class DecomposeVisualizer(MatplotlibVisualizer):
         self.mapped_coloring = map_coloring(self.palette, self.coloring)
 
         self.DG = DecompositionGenerator(self.graph, self.coloring)
+        # Compute the color sets the user is likely to pick next while idle
+        if self.prefetcher is not None:
+            self.prefetcher.cancel()
+        self.prefetcher = DecompositionPrefetcher(self.DG)
+        self.prefetcher.start()
 
         self.update_graph_display(set())
 
+    def on_destroy(self, evt):
+        """Stop prefetching when the visualizer goes away"""
+        if evt.GetEventObject() is self and self.prefetcher is not None:
+            self.prefetcher.cancel()
+        evt.Skip()
+
     def update_graph_display(self, color_set):
         """Update the displayed graph"""
         # Compute what we need for the current color set
-        cc_list = self.DG.get_connected_components(color_set)
-        layouts = self.DG.get_tree_layouts(cc_list
-            , self.coloring)
-        # Draw the graph
+        self.cc_list, self.occurrences, self.layouts, self.boxes = \
+            self.DG.get_decomposition(color_set)
+        self.prefetcher.prefetch(color_set)
+        self.sizes = np.array([cc.number_of_nodes() for cc in self.cc_list],
+                              dtype=int)
+
+        self.summarized = self.sizes.sum() > self.detail_threshold
+        self.detailed = frozenset()
+        if self.summarized:
+            self.draw_components(self.detailed)
+        else:
+            self.draw_components(range(len(self.cc_list)))
+        self.draw_histogram()
+        self.canvas.Refresh()
+
+    def draw_components(self, detailed, limits=None):
+        """
+        Draw the components of the color set on display
+        :param detailed: indices of the components to draw in full; the
+                         others are drawn as glyphs
+        :param limits: x and y limits to keep the view at, or None to fit
+                       the view to the components
+        """
         self.axes.clear()
         self.axes.set_axis_bgcolor((.8,.8,.8))
-        for cc, layout in zip(cc_list, layouts):
+        if limits is not None:
+            # Fixing the limits first also stops drawing from rescaling
+            self.axes.set_xlim(limits[0])
+            self.axes.set_ylim(limits[1])
+        glyphs = []
+        for index, (cc, occ, layout) in enumerate(zip(self.cc_list,
+                self.occurrences, self.layouts)):
+            if index not in detailed:
+                glyphs.append(index)
+                continue
             comp_colors = [self.mapped_coloring[node] for node in cc.nodes()]
-            if cc.occ == 1:
+            if occ == 1:
                 nx.draw_networkx(cc, layout, ax=self.axes, node_color=comp_colors,
                                  with_labels=False)
             else:
                 nx.draw_networkx(cc, layout, ax=self.axes, node_color=comp_colors,
-                                 labels={cc.nodes()[0]:cc.occ})
+                                 labels={cc.nodes()[0]:occ})
+        if glyphs:
+            self.draw_glyphs(glyphs)
+
+    def draw_glyphs(self, indices):
+        """
+        Draw components as a single marker each, sized by their number of
+        vertices, colored like their first vertex and labeled with their
+        number of occurrences
+        :param indices: indices of the components to draw
+        """
+        boxes = self.boxes[indices]
+        centers_x = (boxes[:, 0] + boxes[:, 2]) / 2
+        centers_y = (boxes[:, 1] + boxes[:, 3]) / 2
+        colors = [self.mapped_coloring[self.cc_list[index].nodes()[0]]
+                  for index in indices]
+        marker_sizes = 30 * np.sqrt(self.sizes[indices])
+        self.axes.scatter(centers_x, centers_y, s=marker_sizes, c=colors)
+        for index, x, y in zip(indices, centers_x, centers_y):
+            if self.occurrences[index] > 1:
+                self.axes.text(x, y, str(self.occurrences[index]),
+                               ha='center', va='center')
+
+    def draw_histogram(self):
+        """
+        Show a histogram of component sizes in the corner while components
+        are summarized
+        """
+        if self.histogram_axes is not None:
+            self.figure.delaxes(self.histogram_axes)
+            self.histogram_axes = None
+        if not self.summarized:
+            return
+        self.histogram_axes = self.figure.add_axes([0.74, 0.02, 0.24, 0.18])
+        self.histogram_axes.hist(self.sizes, weights=self.occurrences,
+                                 bins=min(20, len(set(self.sizes))))
+        self.histogram_axes.set_title('Component sizes', fontsize='small')
+        self.histogram_axes.tick_params(labelsize='x-small')
+
+    def visible_components(self):
+        """Indices of the components that are at least partly in view"""
+        x_min, x_max = sorted(self.axes.get_xlim())
+        y_min, y_max = sorted(self.axes.get_ylim())
+        return np.flatnonzero((self.boxes[:, 2] >= x_min) &
+                              (self.boxes[:, 0] <= x_max) &
+                              (self.boxes[:, 3] >= y_min) &
+                              (self.boxes[:, 1] <= y_max))
+
+    def on_view_changed(self, evt):
+        """Update the components drawn in full after zooming or panning"""
+        if self.summarized:
+            wx.CallAfter(self.update_detail)
+
+    def update_detail(self):
+        """
+        While components are summarized, draw the ones in view in full if
+        there are few enough vertices in view
+        """
+        if not self.summarized:
+            return
+        visible = self.visible_components()
+        if self.sizes[visible].sum() > self.detail_threshold:
+            detailed = frozenset()
+        else:
+            detailed = frozenset(visible.tolist())
+        if detailed == self.detailed:
+            return
+        self.detailed = detailed
+        # Redrawing mustn't move the view
+        self.draw_components(detailed, (self.axes.get_xlim(),
+                                        self.axes.get_ylim()))
         self.canvas.Refresh()
 
 
@@ -480,7 +631,7 @@ class CountVisualizer(MatplotlibVisualizer):
     """The visualization for the CONCUSS count stage"""
 
     def __init__(self, parent, graph, pattern, tdd, dptable, coloring,
-            palette_name='brewer'):
+            palette_name='brewer', tdd_layout=None):
         """Create the CONCUSS count visualization"""
         super(CountVisualizer, self).__init__(parent)
 
@@ -493,7 +644,7 @@ class CountVisualizer(MatplotlibVisualizer):
 
         self.colorset = [self.coloring[node] for node in self.tdd.nodes()]
         self.CG = CountGenerator(self.graph, self.pattern, self.tdd,
-                self.dptable, self.coloring, palette_name)
+                self.dptable, self.coloring, palette_name, tdd_layout)
         self.canvas.Bind(wx.EVT_PAINT, self.on_paint)
         self.update_graph_display()
 
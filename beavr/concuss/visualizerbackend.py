@@ -4,182 +4,950 @@
 # the three-clause BSD license; see LICENSE.
 #
 
-import math
+import multiprocessing
 import random
-from itertools import combinations
+from collections import Counter, OrderedDict
+from itertools import combinations, islice
+from threading import Event, Lock, RLock, Thread
 import networkx as nx
-from networkx.algorithms import isomorphism
+import numpy as np
 from numpy import random
+from beavr.concuss.dataloader import DPTable
+from beavr.layout import (digraph_parents, fit_layouts, shelf_pack,
+                          tree_layouts)
 from beavr.util import load_palette, map_coloring, map_colorings
 
 
+class DecompositionCache(object):
+    """
+    Cache of the decompositions of color sets, which evicts the least
+    recently used ones once their estimated size goes over max_bytes
+
+    Entries are tuples of a list of components, the list of their numbers of
+    occurrences, the list of their layouts and the array of their bounding
+    boxes, and are keyed by frozensets of colors.  The cache may be shared
+    between threads.
+    """
+
+    # Rough number of bytes a component's vertex or edge takes up, including
+    # NetworkX's dictionaries and the vertex's layout position
+    vertex_bytes = 1024
+    edge_bytes = 512
+
+    def __init__(self, max_bytes=64 * 2**20):
+        """
+        Create an empty cache
+        :param max_bytes: estimated memory the cache may use
+        """
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.sizes = {}
+        self.size = 0
+        self.lock = RLock()
+
+    def __contains__(self, color_set):
+        with self.lock:
+            return color_set in self.entries
+
+    def get(self, color_set):
+        """
+        Get the decomposition of a color set
+        :param color_set: frozenset of colors
+        :return: The cached entry, or None if there is none
+        """
+        with self.lock:
+            entry = self.entries.pop(color_set, None)
+            if entry is not None:
+                # Mark it as the most recently used
+                self.entries[color_set] = entry
+            return entry
+
+    def put(self, color_set, entry):
+        """
+        Cache the decomposition of a color set
+        :param color_set: frozenset of colors
+        :param entry: tuple of components, occurrences, layouts and boxes
+        """
+        with self.lock:
+            if color_set in self.entries:
+                del self.entries[color_set]
+                self.size -= self.sizes.pop(color_set)
+            self.entries[color_set] = entry
+            self.sizes[color_set] = self.entry_size(entry)
+            self.size += self.sizes[color_set]
+            # Evict the least recently used entries, but always keep this one
+            while self.size > self.max_bytes and len(self.entries) > 1:
+                old_color_set, _ = self.entries.popitem(last=False)
+                self.size -= self.sizes.pop(old_color_set)
+
+    @classmethod
+    def entry_size(cls, entry):
+        """Estimate the number of bytes an entry takes up"""
+        components = entry[0]
+        return sum(cls.vertex_bytes * cc.number_of_nodes() +
+                   cls.edge_bytes * cc.number_of_edges() for cc in components)
+
+
 class DecompositionGenerator(object):
     layout_margin = 0.15
+    # Lay trees out with graphviz's twopi if it is available, rather than
+    # with beavr.layout
+    use_graphviz = False
 
-    def __init__(self, graph, coloring):
+    def __init__(self, graph, coloring, cache=None):
         self.graph = graph
         self.coloring = coloring
+        # Decompositions of color sets that were already computed
+        self.cache = cache if cache is not None else DecompositionCache()
+
+        # The vertices of every color, and the number of edges between every
+        # pair of colors, so the vertices of a color set can be put together
+        # without going through the whole coloring
+        self.color_index = self.make_color_index(coloring)
+        self.color_pair_edges = self.count_color_pair_edges(graph, coloring)
+
+        # The components for the current color set are kept between calls to
+        # get_connected_components and updated as colors are added and
+        # removed.  Components are numbered, and merged union-find style by
+        # relabeling the vertices of the smaller one.
+        self.color_set = set()
+        self.next_component = 0
+        # Vertex -> number of its component
+        self.component_of = {}
+        # Component number -> list of its vertices
+        self.members = {}
+        # Component number -> its smallest vertex, which orders components
+        self.component_min = {}
+        # Component number -> component subgraph, built when first needed
+        self.component_graphs = {}
+        # Component number -> its isomorphism class.  Each class is a list of
+        # a representative component subgraph, the set of numbers of the
+        # components in it, and its certificate.  Classes are stored in lists
+        # by certificate.
+        self.component_class = {}
+        self.classes = {}
 
     def get_connected_components(self, color_set):
         """
         A generator for connected components given a specific color set
 
+        Only the components touched by the colors added or removed since the
+        last call are recomputed.
+
         :param color_set: The color set
         :return: A generator for connected components (subgraphs) induced by
-                 color_set
+                 color_set, one per isomorphism class, with the number of
+                 components in the class in their occ attribute
         """
-
-        # Make an empty set to store vertices
-        v_set = set()
-
-        # Find vertices that are colored with colors in color_set
-        for index, color in enumerate(self.coloring):
-            if color in color_set:
-                v_set.add(index)
+        removed = self.color_set - set(color_set)
+        added = set(color_set) - self.color_set
+        if len(removed) > len(color_set):
+            # Quicker to start over than to take most colors away
+            self.clear_components()
+            removed = set()
+            added = set(color_set)
+        for color in removed:
+            self.remove_color(color)
+        self.add_colors(added)
 
         cc_list = []
-        for new_cc in nx.connected_component_subgraphs(self.graph.subgraph(v_set)):
-            found = False
-            for n in new_cc.node:
-                new_cc.node[n]['color'] = self.coloring[n]
-            for i, cc in enumerate(cc_list):
-                if nx.is_isomorphic(new_cc, cc,
-                        node_match=lambda n1, n2: n1['color'] == n2['color']):
-                    cc_list[i].occ += 1
-                    found = True
-                    break
-            if not found:
-                new_cc.occ = 1
-                cc_list.append(new_cc)
+        classes_seen = set()
+        components = sorted(self.members, key=self.component_min.get)
+        # Classify every component first, so the classes are complete
+        classes = [self.get_component_class(component)
+                   for component in components]
+        for component, cls in zip(components, classes):
+            if id(cls) not in classes_seen:
+                classes_seen.add(id(cls))
+                cc = self.component_graphs[component]
+                cc.occ = len(cls[1])
+                cc_list.append(cc)
         return cc_list
 
+    def get_decomposition(self, color_set):
+        """
+        Get the components for a color set, with their numbers of occurrences
+        and layouts, from the cache if possible
+
+        :param color_set: The color set
+        :return: A list of components as returned by get_connected_components,
+                 a list of their numbers of occurrences, and a list of their
+                 layouts and an array of their bounding boxes as returned by
+                 get_tree_layouts
+        """
+        color_set = frozenset(color_set)
+        entry = self.cache.get(color_set)
+        if entry is None:
+            cc_list = self.get_connected_components(color_set)
+            # occ attributes change when the components are reused for other
+            # color sets, so keep the counts separately
+            occurrences = [cc.occ for cc in cc_list]
+            layouts, boxes = self.get_tree_layouts(cc_list, self.coloring)
+            entry = (cc_list, occurrences, layouts, boxes)
+            self.cache.put(color_set, entry)
+        return entry
+
+    def get_statistics(self, color_set):
+        """
+        Summarize the decomposition of a color set
+
+        :param color_set: The color set
+        :return: A dictionary with the number of components ('components'),
+                 the number of components of each size ('sizes'), and the
+                 number of isomorphism classes of components ('classes')
+        """
+        cc_list = self.get_connected_components(color_set)
+        sizes = Counter()
+        for cc in cc_list:
+            sizes[cc.number_of_nodes()] += cc.occ
+        return {
+            'components': sum(sizes.itervalues()),
+            'sizes': dict(sizes),
+            'classes': len(cc_list)
+        }
+
+    def get_color_set_statistics(self, size, processes=None):
+        """
+        Summarize the decompositions of every color set of a given size, in
+        a pool of worker processes
+
+        Each worker has a generator of its own, and color sets are handed
+        out in order in chunks, so a worker mostly only toggles a color or
+        two between color sets.
+
+        :param size: The number of colors in each color set
+        :param processes: The number of worker processes; by default, the
+                          number of CPUs.  With 1, no processes are started.
+        :return: A list of tuples of a color set and its statistics, as
+                 returned by get_statistics
+        """
+        color_sets = list(combinations(sorted(self.color_index), size))
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+        if processes == 1:
+            generator = DecompositionGenerator(self.graph, self.coloring)
+            statistics = map(generator.get_statistics, color_sets)
+        else:
+            # The graph and coloring are given to the workers when they start
+            # (through fork where there is one) rather than with every task
+            pool = multiprocessing.Pool(processes, init_statistics_worker,
+                                        (self.graph, self.coloring))
+            try:
+                chunksize = max(1, len(color_sets) // (4 * processes))
+                statistics = pool.map(color_set_statistics, color_sets,
+                                      chunksize)
+            finally:
+                pool.terminate()
+                pool.join()
+        return zip(color_sets, statistics)
+
+    @staticmethod
+    def make_color_index(coloring):
+        """
+        Index the vertices of a coloring by color
+        :param coloring: The color of every vertex
+        :return: A dictionary mapping each color to an array of its vertices
+        """
+        colors = np.asarray(coloring)
+        order = np.argsort(colors, kind='mergesort')
+        values, starts = np.unique(colors[order], return_index=True)
+        return dict(zip(values.tolist(), np.split(order, starts[1:])))
+
+    @staticmethod
+    def count_color_pair_edges(graph, coloring):
+        """
+        Count the edges between every pair of colors
+        :param graph: The graph
+        :param coloring: The color of every vertex
+        :return: A dictionary mapping pairs of colors (smallest first) to the
+                 number of edges between them
+        """
+        colors = np.asarray(coloring, dtype=np.int64)
+        edges = np.array(graph.edges(), dtype=np.int64).reshape(-1, 2)
+        # Only vertices with a color can be in a color set
+        edges = edges[((edges >= 0) & (edges < len(colors))).all(axis=1)]
+        if len(edges) == 0:
+            return {}
+        pairs = np.sort(colors[edges], axis=1)
+        base = pairs.max() + 1
+        keys, counts = np.unique(pairs[:, 0] * base + pairs[:, 1],
+                                 return_counts=True)
+        return dict((divmod(key, base), count) for key, count
+                    in zip(keys.tolist(), counts.tolist()))
+
+    def color_vertices(self, color):
+        """The vertices colored with color"""
+        if color not in self.color_index:
+            return []
+        return self.color_index[color].tolist()
+
+    def color_set_vertices(self, color_set):
+        """The vertices colored with any of the colors in color_set"""
+        arrays = [self.color_index[color] for color in color_set
+                  if color in self.color_index]
+        if not arrays:
+            return []
+        return np.concatenate(arrays).tolist()
+
+    def edges_between(self, color, color_set):
+        """The number of edges between color and the colors in color_set"""
+        return sum(self.color_pair_edges.get(
+            (min(color, other), max(color, other)), 0) for other in color_set)
+
+    def add_colors(self, colors):
+        """Add colors to the current color set, merging components"""
+        self.color_set |= set(colors)
+        # The vertices of colors with no edges into the color set are each a
+        # component by themselves, so their neighbors needn't be looked at
+        isolated = [color for color in colors
+                    if not self.edges_between(color, self.color_set)]
+        self.add_vertices(self.color_set_vertices(isolated), merge=False)
+        self.add_vertices(self.color_set_vertices(set(colors) -
+                                                  set(isolated)))
+
+    def remove_color(self, color):
+        """
+        Remove a color from the current color set, recomputing only the
+        components containing vertices of that color
+        """
+        self.color_set.discard(color)
+        affected = set(self.component_of[vertex]
+                       for vertex in self.color_vertices(color)
+                       if vertex in self.component_of)
+        remaining = []
+        for component in affected:
+            for vertex in self.members[component]:
+                del self.component_of[vertex]
+                if self.coloring[vertex] != color:
+                    remaining.append(vertex)
+            self.drop_component(component)
+        self.add_vertices(remaining)
+
+    def clear_components(self):
+        """Remove all colors from the current color set"""
+        self.color_set = set()
+        self.component_of = {}
+        self.members = {}
+        self.component_min = {}
+        self.component_graphs = {}
+        self.component_class = {}
+        self.classes = {}
+
+    def add_vertices(self, vertices, merge=True):
+        """
+        Add vertices to the current components, merging the components of
+        their neighbors
+        :param vertices: The vertices to add
+        :param merge: False if none of the vertices have neighbors in the
+                      current components
+        """
+        adj = self.graph.adj
+        component_of = self.component_of
+        for vertex in vertices:
+            if vertex not in adj:
+                continue
+            component = self.next_component
+            self.next_component += 1
+            component_of[vertex] = component
+            self.members[component] = [vertex]
+            self.component_min[component] = vertex
+            if not merge:
+                continue
+            for nbr in adj[vertex]:
+                if nbr in component_of:
+                    component = self.merge_components(component_of[nbr],
+                                                      component)
+
+    def merge_components(self, first, second):
+        """
+        Merge two components
+        :return: The number of the merged component
+        """
+        if first == second:
+            return first
+        if len(self.members[first]) < len(self.members[second]):
+            first, second = second, first
+        for vertex in self.members[second]:
+            self.component_of[vertex] = first
+        self.members[first].extend(self.members[second])
+        self.component_min[first] = min(self.component_min[first],
+                                        self.component_min[second])
+        self.drop_component(second)
+        # The merged component needs a new subgraph and class
+        self.component_graphs.pop(first, None)
+        self.leave_class(first)
+        return first
+
+    def drop_component(self, component):
+        """Forget a component that was merged or split"""
+        del self.members[component]
+        del self.component_min[component]
+        self.component_graphs.pop(component, None)
+        self.leave_class(component)
+
+    def leave_class(self, component):
+        """Remove a component from its isomorphism class"""
+        cls = self.component_class.pop(component, None)
+        if cls is not None:
+            cls[1].discard(component)
+            if not cls[1]:
+                bucket = self.classes[cls[2]]
+                bucket.remove(cls)
+                if not bucket:
+                    del self.classes[cls[2]]
+
+    def get_component_class(self, component):
+        """
+        Find the isomorphism class of a component, building its subgraph
+        and adding it to a class first if needed
+        """
+        cls = self.component_class.get(component)
+        if cls is not None:
+            return cls
+
+        members = self.members[component]
+        member_set = set(members)
+        adj = self.graph.adj
+        cc = nx.Graph()
+        cc.add_nodes_from((vertex, {'color': self.coloring[vertex]})
+                          for vertex in members)
+        cc.add_edges_from((vertex, nbr) for vertex in members
+                          for nbr in adj[vertex] if nbr in member_set)
+        self.component_graphs[component] = cc
+
+        # Only components with the same certificate can be isomorphic, so
+        # only those need to be compared
+        certificate = self.component_certificate(cc)
+        bucket = self.classes.setdefault(certificate, [])
+        for cls in bucket:
+            if nx.is_isomorphic(cc, cls[0],
+                    node_match=lambda n1, n2: n1['color'] == n2['color']):
+                break
+        else:
+            cls = [cc, set(), certificate]
+            bucket.append(cls)
+        cls[1].add(component)
+        self.component_class[component] = cls
+        return cls
+
+    def component_certificate(self, component):
+        """
+        Compute a certificate of a colored component, which is the same for
+        any two isomorphic components
+
+        The certificate comes from color refinement (the 1-dimensional
+        Weisfeiler-Lehman test): every vertex starts out labeled with its
+        color, and is repeatedly relabeled with its label and the labels of
+        its neighbors until no more vertices are told apart.  Different
+        certificates mean the components aren't isomorphic, but equal ones
+        don't guarantee they are.
+
+        :param component: The component, with vertices colored by
+                          self.coloring
+        :return: A hashable certificate
+        """
+        adj = component.adj
+        labels = dict((node, int(self.coloring[node])) for node in adj)
+        classes = len(set(labels.itervalues()))
+        while True:
+            new_labels = dict((node, hash((labels[node],
+                tuple(sorted(labels[nbr] for nbr in adj[node])))))
+                for node in adj)
+            new_classes = len(set(new_labels.itervalues()))
+            labels = new_labels
+            if new_classes == classes:
+                break
+            classes = new_classes
+        return (component.number_of_edges(), tuple(sorted(labels.values())))
+
     def get_tree_layouts(self, connected_components, coloring):
-        layouts = []
-        for connected_component in connected_components:
-            layouts.append(self.get_tree_layout(connected_component))
-        # Calculate offset
-        y_offset = 0
-        x_offset = 0
-        grid_len = int(math.ceil(math.sqrt(len(layouts))))
-        for layout in layouts:
-            grid_size = 1
+        """
+        Lay out the trees underlying components next to each other
+
+        Each component gets a square whose side grows with the square root
+        of its number of vertices, so its vertices are about as far apart as
+        in any other component, and the squares are packed onto shelves.
+
+        :param connected_components: The components
+        :param coloring: The coloring of the graph
+        :return: A list of layouts, one per component, and an array of the
+                 bounding box (x_min, y_min, x_max, y_max) of each one
+        """
+        layouts = self.get_unit_layouts(connected_components)
+        sides = np.sqrt([connected_component.number_of_nodes()
+                         for connected_component in connected_components])
+        boxes = shelf_pack(sides, sides)
+        for layout, side, box in zip(layouts, sides, boxes):
+            x_offset, y_offset = box[:2]
             for index in layout:
-                layout[index] = [layout[index][0] + x_offset, layout[index][1] + y_offset]
-            x_offset += grid_size
-            if x_offset >= grid_len*grid_size:
-                x_offset = 0
-                y_offset -= grid_size
+                layout[index] = [layout[index][0] * side + x_offset,
+                                 layout[index][1] * side + y_offset]
 
-        return layouts
+        return layouts, boxes
 
     def get_tree_layout(self, connected_component):
-        layout = None
-        tree = self.get_underlying_tree(connected_component)
-        try:
-            # Nice circular layout if you have graphviz
-            from networkx.drawing.nx_agraph import graphviz_layout
-            layout = graphviz_layout(tree, prog='twopi', root=str(tree.root))
-
-            # Scale to fit grid, since twopi seems to ignore the size option
-            min_x = min(pos[0] for pos in layout.values())
-            max_x = max(pos[0] for pos in layout.values())
-            min_y = min(pos[1] for pos in layout.values())
-            max_y = max(pos[1] for pos in layout.values())
-
-            center_x = min_x + (max_x - min_x) / 2
-            center_y = min_y + (max_y - min_y) / 2
-            # Re-center, scale and shift to fit the desired bounding box
-            try:
-                x_scale = (0.5 - self.layout_margin - 0.005) / (center_x - min_x)
-            except ZeroDivisionError:
-                x_scale = 1
-            try:
-                y_scale = (0.5 - self.layout_margin - 0.005) / (center_y - min_y)
-            except ZeroDivisionError:
-                y_scale = 1
-            for vert, pos in layout.iteritems():
-                layout[vert] = ((pos[0] - center_x) * x_scale + 0.5,
-                        (pos[1] - center_y) * y_scale + 0.5)
-
-        except ImportError:
-            # Spring layout if you do not have grahpviz
-            layout = nx.spring_layout(tree, scale=1-2*self.layout_margin-0.01,
-                    center=(0.5, 0.5))
-        return layout
+        return self.get_unit_layouts([connected_component])[0]
 
-    def get_underlying_tree(self, connected_component):
-        # Find the root (color with only one occurrence)
-        root = None
-        colors = [self.coloring[node] for node in connected_component.nodes()]
-        for index, color in enumerate(colors):
-            colors[index] = 'Not a color'
-            if color not in colors:
-                root = connected_component.nodes()[index]
-                break
-            colors[index] = color
+    def get_unit_layouts(self, connected_components):
+        """
+        Lay out the trees underlying components, each one within the margins
+        of the unit square
 
-        # If we can't find a root, something's wrong!
-        if root == None:
-            print 'WARNING: Coloring this has no root', colors
-            return connected_component
+        :param connected_components: The components
+        :return: A list of layouts, one per component
+        """
+        if self.use_graphviz:
+            try:
+                return self.get_graphviz_layouts(
+                    [self.get_underlying_tree(connected_component)
+                     for connected_component in connected_components])
+            except ImportError:
+                pass
+        return tree_layouts((self.get_tree_parents(connected_component)[1]
+                             for connected_component in connected_components),
+                            self.layout_margin)
+
+    def get_graphviz_layouts(self, trees):
+        """
+        Lay out trees with graphviz's twopi, in a single run of it
 
-        # Create a new NetworkX graph to represent the tree
-        tree = nx.Graph()
-        tree.add_node(root)
+        All trees are put in one graph, with their roots marked, so
+        graphviz is only started once however many trees there are.
+
+        :param trees: The trees, as returned by get_underlying_tree
+        :return: A list of layouts, one per tree
+        """
+        from networkx.drawing.nx_agraph import graphviz_layout
+        if not trees:
+            return []
+
+        union = nx.Graph()
+        for index, tree in enumerate(trees):
+            union.add_nodes_from((index, vertex) for vertex in tree)
+            union.add_edges_from(((index, u), (index, v))
+                                 for u, v in tree.edges())
+            # twopi puts the root of each connected component in its center
+            union.node[(index, tree.root)]['root'] = 'true'
+        positions = graphviz_layout(union, prog='twopi')
+
+        tree_nodes = [tree.nodes() for tree in trees]
+        points = np.array([positions[(index, vertex)]
+                           for index, nodes in enumerate(tree_nodes)
+                           for vertex in nodes], dtype=float)
+        points = fit_layouts(points, [len(nodes) for nodes in tree_nodes],
+                             self.layout_margin)
 
-        # Remove the root from the connected component
-        connected_component = nx.Graph(connected_component)
-        connected_component.remove_node(root)
+        layouts = []
+        start = 0
+        for nodes in tree_nodes:
+            end = start + len(nodes)
+            layouts.append(dict(zip(nodes,
+                                    map(tuple, points[start:end].tolist()))))
+            start = end
+        return layouts
 
-        # Every new connected component is a subtree
-        for sub_cc in nx.connected_component_subgraphs(connected_component):
-            subtree = self.get_underlying_tree(sub_cc)
-            tree = nx.compose(tree, subtree)
-            tree.add_edge(root, subtree.root)
+    def get_underlying_tree(self, connected_component):
+        """
+        Build the treedepth decomposition tree underlying a component
 
-        # Root field for use in recursive case to connect tree and subtree
+        :param connected_component: The component
+        :return: The tree, with its root in its root attribute
+        """
+        root, parents = self.get_tree_parents(connected_component)
+        tree = nx.Graph()
+        tree.add_nodes_from(parents)
+        tree.add_edges_from((vertex, parent)
+                            for vertex, parent in parents.iteritems()
+                            if parent is not None)
         tree.root = root
         return tree
 
+    def get_tree_parents(self, connected_component):
+        """
+        Find the parent of every vertex in the treedepth decomposition tree
+        underlying a component
+
+        The root of a component is its first vertex with a color that occurs
+        only once in it.  Removing the root splits the rest of the component
+        into subcomponents, whose roots are the root's children, and so on.
+        The subcomponents are handled from a worklist rather than by
+        recursion, so deep components can't hit the recursion limit.
+
+        :param connected_component: The component
+        :return: The root, and a dictionary mapping every vertex to its
+                 parent (None for the root)
+        """
+        adj = connected_component.adj
+        coloring = self.coloring
+        parents = {}
+        root = None
+        # Subcomponents still to be handled, as lists of vertices in the
+        # order of connected_component.nodes(), with their parents
+        worklist = [(connected_component.nodes(), None)]
+        while worklist:
+            vertices, parent = worklist.pop()
+
+            # Find the root (color with only one occurrence)
+            color_counts = Counter(coloring[vertex] for vertex in vertices)
+            sub_root = next((vertex for vertex in vertices
+                             if color_counts[coloring[vertex]] == 1), None)
+            # If we can't find a root, something's wrong!
+            if sub_root is None:
+                print 'WARNING: Coloring this has no root', \
+                    [coloring[vertex] for vertex in vertices]
+                sub_root = vertices[0]
+            parents[sub_root] = parent
+            if parent is None:
+                root = sub_root
+
+            # Every connected component left after removing the root is a
+            # subtree
+            inside = set(vertices)
+            inside.discard(sub_root)
+            component_of = {}
+            subcomponents = []
+            for start in vertices:
+                if start == sub_root or start in component_of:
+                    continue
+                component_of[start] = len(subcomponents)
+                subcomponents.append([])
+                stack = [start]
+                while stack:
+                    vertex = stack.pop()
+                    for nbr in adj[vertex]:
+                        if nbr in inside and nbr not in component_of:
+                            component_of[nbr] = component_of[start]
+                            stack.append(nbr)
+            for vertex in vertices:
+                if vertex != sub_root:
+                    subcomponents[component_of[vertex]].append(vertex)
+            worklist.extend((subcomponent, sub_root)
+                            for subcomponent in subcomponents)
+        return root, parents
+
+
+# The generator of a worker process of get_color_set_statistics
+statistics_generator = None
+
+def init_statistics_worker(graph, coloring):
+    """Set up a worker process of get_color_set_statistics"""
+    global statistics_generator
+    statistics_generator = DecompositionGenerator(graph, coloring)
+
+def color_set_statistics(color_set):
+    """Summarize a color set in a worker process of get_color_set_statistics"""
+    return statistics_generator.get_statistics(color_set)
+
+
+class DecompositionPrefetcher(Thread):
+    """
+    Thread that fills a DecompositionGenerator's cache in the background
+    with the decompositions of the color sets one toggle away from the one
+    being displayed
+
+    The thread has a generator of its own sharing the cache, since
+    generators keep the components of the last color set they were used for.
+    """
+
+    def __init__(self, generator):
+        """
+        Create the thread; call start() to begin, then prefetch() whenever
+        the color set being displayed changes
+        :param generator: DecompositionGenerator whose cache to fill
+        """
+        super(DecompositionPrefetcher, self).__init__(
+            name='DecompositionPrefetcher')
+        self.daemon = True
+
+        self.generator = DecompositionGenerator(generator.graph,
+                                                generator.coloring,
+                                                generator.cache)
+        self.colors = sorted(self.generator.color_index)
+        self.color_set = frozenset()
+        self.lock = Lock()
+        self.requested = Event()
+        self.cancelled = Event()
+
+    def prefetch(self, color_set):
+        """Start prefetching around a color set, dropping any previous one"""
+        with self.lock:
+            self.color_set = frozenset(color_set)
+        self.requested.set()
+
+    def cancel(self):
+        """Stop the thread once the color set being computed is done"""
+        self.cancelled.set()
+        self.requested.set()
+
+    def run(self):
+        """Compute decompositions until cancelled"""
+        while True:
+            self.requested.wait()
+            if self.cancelled.is_set():
+                return
+            self.requested.clear()
+            with self.lock:
+                color_set = self.color_set
+            for color in self.colors:
+                # Give up on this color set if there's a newer one
+                if self.requested.is_set():
+                    break
+                neighbor = color_set ^ {color}
+                if neighbor not in self.generator.cache:
+                    self.generator.get_decomposition(neighbor)
+
+
+class TDDIndex(object):
+    """
+    Index of the ancestors and descendants in a treedepth decomposition
+
+    The decomposition is a DiGraph with edges from vertices to their
+    parents.  Every vertex's parent and depth are stored, along with the
+    times a depth-first traversal enters and leaves it, so that the
+    vertices of a subtree are a slice of the traversal order and ancestry
+    can be tested in constant time.  Root paths are built from their
+    parents' and cached.
+    """
+
+    def __init__(self, tdd):
+        """
+        Index a treedepth decomposition
+        :param tdd: DiGraph with edges from vertices to their parents
+        """
+        self.parent = {}
+        self.depth = {}
+        # Vertices in depth-first order, and the range of positions of each
+        # vertex's subtree in it
+        self.order = []
+        self.enter = {}
+        self.leave = {}
+        self.root_paths = {}
+
+        self.roots = [v for v in tdd if not tdd.succ[v]]
+        for root in self.roots:
+            self.parent[root] = None
+            self.depth[root] = 0
+            stack = [(root, iter(tdd.pred[root]))]
+            self.enter[root] = len(self.order)
+            self.order.append(root)
+            while stack:
+                v, children = stack[-1]
+                child = next(children, None)
+                if child is None:
+                    self.leave[v] = len(self.order)
+                    stack.pop()
+                    continue
+                self.parent[child] = v
+                self.depth[child] = self.depth[v] + 1
+                self.enter[child] = len(self.order)
+                self.order.append(child)
+                stack.append((child, iter(tdd.pred[child])))
+
+    def root_path(self, vertex):
+        """
+        Get the ancestors of a vertex
+        :param vertex: The vertex
+        :return: A list of the vertex's ancestors, from the root down
+        """
+        path = self.root_paths.get(vertex)
+        if path is None:
+            # Build the missing paths top-down, so none is rebuilt
+            missing = []
+            v = vertex
+            while v is not None and v not in self.root_paths:
+                missing.append(v)
+                v = self.parent[v]
+            for v in reversed(missing):
+                parent = self.parent[v]
+                self.root_paths[v] = ([] if parent is None else
+                                      self.root_paths[parent] + [parent])
+            path = self.root_paths[vertex]
+        return list(path)
+
+    def is_ancestor(self, ancestor, vertex):
+        """Check whether a vertex is in the subtree rooted at another one"""
+        return (self.enter[ancestor] <= self.enter[vertex] <
+                self.leave[ancestor])
+
+    def subforest(self, vertices):
+        """
+        Get the union of the subtrees rooted at some vertices
+        :param vertices: The roots of the subtrees
+        :return: A list of the vertices in the subtrees, each once
+        """
+        # Subtrees are disjoint unless one contains the other, so only the
+        # outermost ones are kept
+        starts = sorted(set(vertices), key=self.enter.get)
+        subforest = []
+        end = -1
+        for v in starts:
+            if self.enter[v] >= end:
+                end = self.leave[v]
+                subforest.extend(self.order[self.enter[v]:end])
+        return subforest
+
 
 class CountGenerator(object):
     layout_margin = 0.15
+    # Lay the tdd out with graphviz's twopi if it is available, rather than
+    # with beavr.layout
+    use_graphviz = False
     k_pat_count = 3
     subgraph_count = 4
+    # Random blocks to try per k-pattern when the DP table isn't indexed
+    sample_tries = 20
 
-    def __init__(self, graph, pattern, tdd, dptable, coloring, palette_name):
+    def __init__(self, graph, pattern, tdd, dptable, coloring, palette_name,
+                 layout=None):
         self.graph = graph
         self.pattern = pattern
         self.tdd = tdd
+        self.tdd_index = TDDIndex(tdd)
         self.dptable = dptable
         self.coloring = coloring
 
         self.palette = load_palette(palette_name)
         self.mapped_coloring = map_coloring(self.palette, self.coloring)
 
-        self.isomorphism_list = None
+        # Attributes of the graph's panels are arrays over these orders of its
+        # vertices and edges, which are the orders they are drawn in
+        self.graph_nodes = self.graph.nodes()
+        self.node_index = dict((v, i) for i, v in enumerate(self.graph_nodes))
+        self.graph_edges = self.graph.edges()
+        self.edge_index = {}
+        for i, (u, v) in enumerate(self.graph_edges):
+            self.edge_index[u, v] = i
+            self.edge_index[v, u] = i
+        self.node_colors = np.array(
+                [self.mapped_coloring[v] for v in self.graph_nodes],
+                dtype=float).reshape(-1, 3)
+
+        # The tdd is laid out once, and every panel showing it gets a shifted
+        # copy of its positions; the same goes for the pattern
+        if layout is None:
+            layout = self.get_layout(self.graph)
+        else:
+            layout = self.fit_layout(layout)
+        self.layout_vertices = layout.keys()
+        self.layout_points = np.array([layout[v] for v in self.layout_vertices],
+                                      dtype=float).reshape(-1, 2)
+        pattern_layout = nx.spring_layout(self.pattern,
+                scale=1-2*self.layout_margin-0.01, center=(0.5, 0.5))
+        self.pattern_vertices = pattern_layout.keys()
+        self.pattern_points = np.array(
+                [pattern_layout[v] for v in self.pattern_vertices],
+                dtype=float).reshape(-1, 2)
 
+        self.index_patterns()
         self.get_patterns()
 
+    def index_patterns(self):
+        """
+        Index the k-patterns of an in-memory DP table that can be displayed,
+        which are those with a non-empty boundary that maps onto the root
+        path of their vertices
+
+        The index is built from the table's arrays, without building its
+        entries.  Other tables, such as those read from disk, are sampled a
+        block at a time instead.
+        """
+        if not isinstance(self.dptable, DPTable):
+            self.pattern_entries = None
+            self.pattern_keys = self.dptable.keys()
+            return
+        table = self.dptable
+        # The length of the root path of each block's first vertex, where a
+        # root is its own root path
+        has_key = np.diff(table.key_offsets) > 0
+        first_vertices = table.key_vertices[table.key_offsets[:-1][has_key]]
+        path_lengths = np.zeros(len(has_key), dtype=np.int64)
+        path_lengths[has_key] = [max(self.tdd_index.depth[v], 1)
+                                 for v in first_vertices.tolist()]
+        entry_path_lengths = np.repeat(path_lengths,
+                                       np.diff(table.entry_offsets))
+        max_labels = table.max_boundary_labels()
+        self.pattern_entries = np.flatnonzero(
+                (max_labels >= 0) & (max_labels < entry_path_lengths))
+
+    def is_displayable(self, k_pat, vertices):
+        """Check whether a k-pattern's boundary maps onto its root path"""
+        return bool(k_pat[2]) and (max(k_pat[2].itervalues()) <
+                                   len(self.get_root_path(vertices[0])))
+
+    def sample_patterns(self, count):
+        """
+        Choose distinct displayable k-patterns at random
+
+        Indexed k-patterns are chosen with Floyd's algorithm, which takes
+        exactly count draws.  Otherwise random blocks are tried, at most
+        sample_tries times per k-pattern.
+
+        :param count: The number of k-patterns to choose
+        :return: A list of the vertex tuples and entries of the k-patterns
+        """
+        if self.pattern_entries is None:
+            return self.sample_blocks(count)
+        total = len(self.pattern_entries)
+        count = min(count, total)
+        chosen = set()
+        picks = []
+        for last in range(total - count, total):
+            pick = random.randint(0, last + 1)
+            if pick in chosen:
+                pick = last
+            chosen.add(pick)
+            picks.append(pick)
+        random.shuffle(picks)
+
+        patterns = []
+        for pick in picks:
+            index = self.pattern_entries[pick]
+            block = self.dptable.entry_block(index)
+            patterns.append((self.dptable.block_key(block),
+                             self.dptable.entry(index)))
+        return patterns
+
+    def sample_blocks(self, count):
+        """
+        Choose distinct displayable k-patterns from random blocks of the DP
+        table, giving up after sample_tries tries per k-pattern
+
+        :param count: The number of k-patterns to choose
+        :return: A list of the vertex tuples and entries of the k-patterns
+        """
+        chosen = set()
+        patterns = []
+        if not self.pattern_keys:
+            return patterns
+        for _ in range(self.sample_tries * count):
+            if len(patterns) == count:
+                break
+            vertices = self.pattern_keys[random.randint(len(self.pattern_keys))]
+            entries = self.dptable[vertices]
+            displayable = [index for index, k_pat in enumerate(entries)
+                           if self.is_displayable(k_pat, vertices)]
+            if not displayable:
+                continue
+            index = displayable[random.randint(len(displayable))]
+            if (vertices, index) not in chosen:
+                chosen.add((vertices, index))
+                patterns.append((vertices, entries[index]))
+        return patterns
+
     def get_patterns(self):
-        """Get some k-patterns and complete motifs"""
+        """
+        Get some k-patterns and complete motifs; fewer than k_pat_count if
+        not enough of the DP table's k-patterns can be displayed
+        """
         self.k_patterns = []
         self.k_pattern_mapped = []
         self.motifs = []
         self.vertices_list = []
 
-        while len(self.k_patterns) < self.k_pat_count:
-            # Get a random set of vertices from the DP table
-            vertices = random.choice(self.dptable.keys())
+        for vertices, k_pat in self.sample_patterns(self.k_pat_count):
             # Get the root path
             root_path = self.get_root_path(vertices[0])
 
-            # Get a k-pattern from that part of the DP table
-            k_pat = self.get_pattern(vertices, root_path)
-            # If we didn't get a k-pattern, try again with another vertex set
-            if k_pat is None:
-                continue
-            # Now that we know the vertex set is okay, remember it
             self.vertices_list.append(vertices)
             # Get the vertices on the k-pattern's boundary
             k_pat_boundary_vertices = [root_path[v] for v in k_pat[2].itervalues()]
@@ -192,163 +960,157 @@ class CountGenerator(object):
             motifs = self.get_motifs_for_k_pattern(k_pat, vertices, root_path)
             self.motifs.append(motifs)
 
-    def get_pattern(self, vertices, root_path):
-        """Return an interesting k-pattern from the given part of the table"""
-        good_pattern = False
-
-        # Copy the part of the table we're interested in
-        subtable = list(self.dptable[vertices])
-        # Shuffle it to avoid being boring
-        random.shuffle(subtable)
-
-        # Look at all the k-patterns in a shuffled order
-        for k_pat in subtable:
-            good_pattern = True
-            pi = k_pat[2]
-            # Make sure we have a non-empty boundary
-            if not pi:
-                good_pattern = False
-            # Make sure the k-pattern can actually map to the component
-            for mapping in pi.itervalues():
-                if mapping >= len(root_path):
-                    good_pattern = False
-                    break
-            # If the k-pattern looks interesting, return it
-            if good_pattern:
-                return k_pat
-        # At this point we've looked at every k-pattern and they all looked
-        # dreadfully boring, so return None
-        return None
-
     def get_motifs_for_k_pattern(self, k_pat, vertices, root_path):
         """Return a list of subgraphs isomorphic to the motif"""
-        motifs = []
-        sv = self.get_subforest_vertices(vertices)
-
-        if self.isomorphism_list is None:
-            gm = isomorphism.GraphMatcher(self.graph, self.pattern)
-            self.isomorphism_list = list(gm.subgraph_isomorphisms_iter())
-
-        for im in self.isomorphism_list:
-            matches_k_pat = True
-            # Reverse the mapping
-            imr = {v: k for k, v in im.iteritems()}
-            for v in k_pat[1]:
-                # Check that boundary vertices are mapped right
-                if v in k_pat[2]:
-                    if imr[v] != root_path[k_pat[2][v]]:
-                        matches_k_pat = False
-                        break
-                # Check that non-boundary vertices in the k-pattern are in the
-                # right part of the graph
-                elif imr[v] not in sv:
-                    matches_k_pat = False
-                    break
-            # Make sure that the vertices in the k-pattern aren't in the
-            # subforest
-            for cv, pv in im.iteritems():
-                if pv not in k_pat[1] and cv in sv:
-                    matches_k_pat = False
-                    break
-            # Check that im matches the k-pattern
-            if matches_k_pat:
-                # Append a subgraph
-                motifs.append(nx.relabel_nodes(self.pattern, imr))
-            # Don't add too many
-            if len(motifs) >= self.subgraph_count:
-                break
-
-        return motifs
+        sv = set(self.get_subforest_vertices(vertices))
+        return [nx.relabel_nodes(self.pattern, imr) for imr in
+                islice(self.match_k_pattern(k_pat, root_path, sv),
+                       self.subgraph_count)]
 
-    def get_root_path(self, vertex, top_level=True):
+    def match_k_pattern(self, k_pat, root_path, subforest):
+        """
+        Generate the copies of the pattern in the graph that the k-pattern
+        is part of, by backtracking from its boundary
+
+        A copy is an induced subgraph of the graph.  The boundary vertices of
+        the k-pattern are mapped to their places on the root path, its other
+        vertices into the subforest, and the remaining vertices of the
+        pattern outside of the subforest.  Pattern vertices are matched in
+        an order where each one, if it can, has a neighbor matched before
+        it, so its candidates are that neighbor's neighbors.
+
+        :param k_pat: The k-pattern
+        :param root_path: The root path of the k-pattern's vertices
+        :param subforest: The set of vertices of their subforest
+        :return: A generator of mappings from the pattern's vertices to the
+                 graph's
+        """
+        graph = self.graph
+        pattern = self.pattern
+
+        imr = {}
+        for v, index in k_pat[2].iteritems():
+            imr[v] = root_path[index]
+        # The boundary has to be a copy of its part of the pattern by itself
+        if len(set(imr.itervalues())) < len(imr):
+            return
+        for u, v in combinations(imr, 2):
+            if graph.has_edge(imr[u], imr[v]) != pattern.has_edge(u, v):
+                return
+
+        def in_domain(v, w):
+            return (w in subforest) == (v in k_pat[1])
+
+        # Match the pattern's vertices next to matched ones first
+        order = []
+        matched = set(imr)
+        unmatched = set(pattern) - matched
+        while unmatched:
+            v = max(unmatched, key=lambda u: (
+                sum(1 for x in pattern.neighbors(u) if x in matched),
+                pattern.degree(u)))
+            order.append(v)
+            matched.add(v)
+            unmatched.remove(v)
+
+        used = set(imr.itervalues())
+
+        def extend(position):
+            if position == len(order):
+                yield dict(imr)
+                return
+            v = order[position]
+            anchors = [imr[u] for u in pattern.neighbors(v) if u in imr]
+            if anchors:
+                candidates = graph.neighbors(min(anchors, key=graph.degree))
+            elif v in k_pat[1]:
+                candidates = subforest
+            else:
+                candidates = graph.nodes()
+            for w in candidates:
+                if (w in used or not in_domain(v, w) or
+                        graph.degree(w) < pattern.degree(v)):
+                    continue
+                # The copy has to be induced
+                if any(graph.has_edge(w, imr[u]) != pattern.has_edge(v, u)
+                       for u in imr):
+                    continue
+                imr[v] = w
+                used.add(w)
+                for match in extend(position + 1):
+                    yield match
+                used.remove(w)
+                del imr[v]
+
+        for match in extend(0):
+            yield match
+
+    def get_root_path(self, vertex):
         """Return the root path for the given vertex"""
-        parent = self.tdd.successors(vertex)
-        if len(parent) == 0:
+        # A root is its own root path
+        if self.tdd_index.parent[vertex] is None:
             return [vertex]
-
-        root_path = self.get_root_path(parent[0], top_level=False)
-        if not top_level:
-            root_path.append(vertex)
-        return root_path
+        return self.tdd_index.root_path(vertex)
 
     def get_subforest_vertices(self, vertices):
         """Get the vertices from the union of subtrees rooted at vertices"""
-        # Copy the given vertices
-        subforest = list(vertices)
-
-        for v in vertices:
-            pred = self.tdd.predecessors(v)
-            if pred:
-                subforest.extend(self.get_subforest_vertices(pred))
-
-        return subforest
+        return self.tdd_index.subforest(vertices)
 
     def get_layouts(self):
         k_pattern_layouts = []
-        # Compute layout for the k-pattern
-        layout = nx.spring_layout(self.pattern,
-                scale=1-2*self.layout_margin-0.01, center=(0.5, 0.5))
-        for motifs in self.motifs:
-            motif_layouts = []
-            # Layout for k-pattern
-            motif_layouts.append(dict(layout))
-            # Layout for k-pattern highlighted in component
-            motif_layouts.append(self.get_layout(self.graph))
-            # Layouts for component copies
-            for _ in motifs:
-                motif_layouts.append(self.get_layout(self.graph))
+        # Each k-pattern gets a column, with the k-pattern at the top, then
+        # the k-pattern highlighted in the component, then component copies
+        for x_offset, motifs in enumerate(self.motifs):
+            motif_layouts = [self.shift_layout(self.pattern_vertices,
+                                               self.pattern_points,
+                                               x_offset, 0)]
+            for y_offset in range(-1, -len(motifs) - 2, -1):
+                motif_layouts.append(self.shift_layout(self.layout_vertices,
+                                                       self.layout_points,
+                                                       x_offset, y_offset))
             k_pattern_layouts.append(motif_layouts)
-                
-        # Calculate offset
-        y_offset = 0
-        x_offset = 0
-        for layouts in k_pattern_layouts:
-            for layout in layouts:
-                grid_size = 1
-                for index in layout:
-                    layout[index] = [layout[index][0] + x_offset, layout[index][1] + y_offset]
-                y_offset -= grid_size
-            x_offset += grid_size
-            y_offset = 0
-
-        return k_pattern_layouts 
+
+        return k_pattern_layouts
+
+    def shift_layout(self, vertices, points, x_offset, y_offset):
+        """
+        Make a layout from positions moved by an offset
+
+        :param vertices: The vertices
+        :param points: Array of the positions of the vertices
+        :param x_offset: Offset to add to every x coordinate
+        :param y_offset: Offset to add to every y coordinate
+        :return: A dictionary mapping every vertex to its new position
+        """
+        return dict(zip(vertices, (points + (x_offset, y_offset)).tolist()))
+
+    def fit_layout(self, layout):
+        """
+        Scale a layout to fit within the margins of the unit square
+
+        :param layout: A dictionary mapping vertices to positions
+        :return: A dictionary mapping every vertex to its new position
+        """
+        nodes = layout.keys()
+        points = fit_layouts(np.array([layout[node] for node in nodes],
+                                      dtype=float),
+                             [len(nodes)], self.layout_margin)
+        return dict(zip(nodes, map(tuple, points.tolist())))
 
     def get_layout(self, graph):
-        layout = None
         tree = self.tdd
-        root = self.get_tdd_root()
-        try:
-            # Nice circular layout if you have graphviz
-            from networkx.drawing.nx_agraph import graphviz_layout
-            layout = graphviz_layout(tree, prog='twopi',
-                    args='-Groot={0}'.format(root))
-
-            # Scale to fit grid, since twopi seems to ignore the size option
-            min_x = min(pos[0] for pos in layout.values())
-            max_x = max(pos[0] for pos in layout.values())
-            min_y = min(pos[1] for pos in layout.values())
-            max_y = max(pos[1] for pos in layout.values())
-
-            center_x = min_x + (max_x - min_x) / 2
-            center_y = min_y + (max_y - min_y) / 2
-            # Re-center, scale and shift to fit the desired bounding box
-            try:
-                x_scale = (0.5 - self.layout_margin - 0.005) / (center_x - min_x)
-            except ZeroDivisionError:
-                x_scale = 1
+        if self.use_graphviz:
             try:
-                y_scale = (0.5 - self.layout_margin - 0.005) / (center_y - min_y)
-            except ZeroDivisionError:
-                y_scale = 1
-            for vert, pos in layout.iteritems():
-                layout[vert] = ((pos[0] - center_x) * x_scale + 0.5,
-                        (pos[1] - center_y) * y_scale + 0.5)
-
-        except ImportError:
-            # Spring layout if you do not have grahpviz
-            layout = nx.spring_layout(tree, scale=1-2*self.layout_margin-0.01,
-                    center=(0.5, 0.5))
-        return layout
+                # Nice circular layout if you have graphviz
+                from networkx.drawing.nx_agraph import graphviz_layout
+                layout = graphviz_layout(tree, prog='twopi',
+                        args='-Groot={0}'.format(self.get_tdd_root()))
+                # Scale to fit grid, since twopi seems to ignore the size
+                # option
+                return self.fit_layout(layout)
+            except ImportError:
+                pass
+        return tree_layouts([digraph_parents(tree)], self.layout_margin)[0]
 
     def get_attributes(self):
         """
@@ -381,7 +1143,7 @@ class CountGenerator(object):
             # Color the nodes
             for node in self.pattern.nodes():
                 # Boundary vertices are black with a normal outline
-                if node in k_pattern[2].keys():
+                if node in k_pattern[2]:
                     line_widths.append(1)
                     vertex_colors.append([0, 0, 0])
                     labels[node] = k_pattern[2][node]
@@ -405,25 +1167,17 @@ class CountGenerator(object):
             attribute_list.append(k_pattern_attributes)
 
             # Next, attributes for the k-pattern in the subgraph
-            # Color vertices in the header
-            vertex_colors = []
-            line_widths = []
-            labels = {}
-            subforest = self.get_subforest_vertices(vertices)
-            for node in self.graph.nodes():
-                # Anonymous vertices are white with a normal outline
-                if node in subforest:
-                    line_widths.append(1)
-                    vertex_colors.append([1, 1, 1])
-                # Boundary vertices are black with a normal outline
-                elif node in boundary_map:
-                    line_widths.append(1)
-                    vertex_colors.append([0, 0, 0])
-                    labels[node] = self.root_path_index(node)
-                # Other vertices are gray with a thin outline
-                else:
-                    line_widths.append(0.5)
-                    vertex_colors.append([0.8, 0.8, 0.8])
+            # Anonymous vertices are white and boundary vertices black, both
+            # with a normal outline; other vertices are gray with a thin one
+            subforest = self.node_mask(self.get_subforest_vertices(vertices))
+            boundary = self.node_mask(boundary_map) & ~subforest
+            vertex_colors = np.tile(0.8, (len(self.graph_nodes), 3))
+            vertex_colors[subforest] = 1
+            vertex_colors[boundary] = 0
+            line_widths = np.where(subforest | boundary, 1, 0.5)
+            labels = dict((self.graph_nodes[i], self.root_path_index(
+                               self.graph_nodes[i]))
+                          for i in np.flatnonzero(boundary))
 
             k_pattern_attributes = {
                 "node_color": vertex_colors,
@@ -436,44 +1190,30 @@ class CountGenerator(object):
             }
             attribute_list.append(k_pattern_attributes)
 
+            boundary = self.node_mask(boundary_map)
             for motif, layout in zip(motifs, layout_list[2:]):
+                in_motif = self.node_mask(motif)
                 # Make the non-motif nodes small, and the boundary nodes big
-                node_sizes = []
-                for node in self.graph.nodes():
-                    if node in boundary_map:
-                        node_sizes.append(default_size * 2)
-                    elif node in motif.nodes():
-                        node_sizes.append(default_size)
-                    else:
-                        node_sizes.append(default_size * 0.5)
+                node_sizes = np.where(boundary, default_size * 2,
+                                      np.where(in_motif, default_size,
+                                               default_size * 0.5))
 
                 # Widen outlines of motif nodes
-                line_widths = [line_width * 3 if n in motif.nodes() else line_width for n in self.graph.nodes()]
-
-                # Color the nodes
-                comp_colors = [self.mapped_coloring[node] for node in self.graph.nodes()]
-
-                # Widen the motif edges
-                edge_widths = []
-                motif_edges = motif.edges()
-                for edge in self.graph.edges():
-                    if edge in motif_edges or tuple(reversed(edge)) in motif_edges:
-                        edge_widths.append(edge_width * 3)
-                    else:
-                        edge_widths.append(edge_width)
-
-                # Dashed non-motif edges, solid motif edges
-                style = []
-                for edge in self.graph.edges():
-                    if edge in motif_edges or tuple(reversed(edge)) in motif_edges:
-                        style.append("solid")
-                    else:
-                        style.append("dashed")
+                line_widths = np.where(in_motif, line_width * 3, line_width)
+
+                # Widen the motif edges, which are solid, while the others
+                # are dashed
+                motif_edges = np.zeros(len(self.graph_edges), dtype=bool)
+                motif_edges[np.array([self.edge_index[edge]
+                                      for edge in motif.edges()],
+                                     dtype=np.intp)] = True
+                edge_widths = np.where(motif_edges, edge_width * 3, edge_width)
+                style = np.where(motif_edges, "solid", "dashed").tolist()
 
                 motif_attributes = {
                     "node_size": node_sizes,
                     "linewidths": line_widths,
-                    "node_color": comp_colors,
+                    "node_color": self.node_colors,
                     "width": edge_widths,
                     "style": style,
                     "with_labels": False,
@@ -486,16 +1226,25 @@ class CountGenerator(object):
 
         return attributes 
 
+    def node_mask(self, vertices):
+        """
+        Find some vertices in the graph's order of its vertices
+
+        :param vertices: The vertices; those not in the graph are ignored
+        :return: A boolean array of which of the graph's vertices are given
+        """
+        mask = np.zeros(len(self.graph_nodes), dtype=bool)
+        mask[np.array([self.node_index[v] for v in vertices
+                       if v in self.node_index], dtype=np.intp)] = True
+        return mask
+
     def root_path_index(self, vertex):
         """Return the index of the given vertex on a root path"""
-        return nx.shortest_path_length(self.tdd, source=vertex,
-                target=self.get_tdd_root())
+        return self.tdd_index.depth[vertex]
 
     def get_tdd_root(self):
         """Find the root of the treedepth decomposition"""
-        for node in self.tdd.nodes():
-            if self.tdd.out_degree(node) == 0:
-                return node
+        return self.tdd_index.roots[0]
 
 class CombineSetGenerator(object):
     def __init__(self, color_set, colors, pattern_size, min_size):
@@ -4,17 +4,48 @@
 # the three-clause BSD license; see LICENSE.
 #
 
-from abc import ABCMeta, abstractmethod
+from abc import ABCMeta
 from zipfile import ZipFile
 import ConfigParser
 from os.path import basename, exists
 from importlib import import_module
+from threading import Event, Lock, RLock, Thread
+
+from beavr.cache import ArchiveCache
+
+
+class lazy_section(object):
+    """
+    Decorator for DataLoader methods that parse one section of an archive
+
+    The decorated method is run the first time the attribute of the same name
+    is accessed, and its result is cached on the DataLoader for every later
+    access.  Parsing is serialized with the DataLoader's lock, so a section is
+    never parsed twice even if it is requested from several threads.
+    """
+
+    def __init__(self, loader):
+        self.loader = loader
+        self.name = loader.__name__
+        self.__doc__ = loader.__doc__
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        with instance.lock:
+            # Another thread may have parsed the section while we waited
+            if self.name not in instance.__dict__:
+                instance.__dict__[self.name] = self.loader(instance)
+        return instance.__dict__[self.name]
 
 
 class DataLoader(object):
     """ Abstract Data Loader """
     __metaclass__ = ABCMeta
 
+    # Names of the lazy sections provided by this DataLoader
+    sections = ()
+
     def __init__(self, archive, parser):
         """
         Get the json configuration loaded by the DataLoaderFactory
@@ -22,28 +53,103 @@ class DataLoader(object):
         """
         self.archive = archive
         self.parser = parser
+        self.lock = RLock()
+        self.cache = ArchiveCache.for_archive(archive)
+
+    def load(self, sections=None):
+        """
+        Parse the given sections of self.archive now instead of on first use
+        :param sections: names of the sections to parse, or None for all
+        """
+        if sections is None:
+            sections = self.sections
+        for name in sections:
+            getattr(self, name)
+
+    def is_loaded(self, name):
+        """
+        Check whether a section has already been parsed
+        :param name: name of the section
+        :returns: True if accessing the section will not read the archive
+        """
+        return name in self.__dict__
 
-    @abstractmethod
-    def load(self):
+    def cached(self, name, load, pack, unpack):
         """
-        Load data from self.archive
+        Load a section from the archive's cache, or parse and cache it
+        :param name: name of the section
+        :param load: function parsing the section from the archive
+        :param pack: function converting the parsed section to a dictionary
+                     of arrays, or raising OverflowError if it can't
+        :param unpack: function converting a dictionary of arrays back
+        :returns: the parsed section
         """
+        if self.cache is None:
+            return load()
+        arrays = self.cache.load(name)
+        if arrays is not None:
+            try:
+                return unpack(arrays)
+            except (KeyError, ValueError, IndexError, TypeError):
+                # The cached arrays are damaged, so parse the section again
+                # and replace them
+                pass
+        value = load()
+        try:
+            self.cache.store(name, pack(value))
+        except OverflowError:
+            # Some numbers don't fit in an array, so don't cache this one
+            pass
+        return value
+
+    def section_members(self, name):
+        """
+        Names of the archive members a section is parsed from
+        :param name: name of the section
+        :returns: list of member names
+        """
+        return []
+
+    def section_size(self, name):
+        """
+        Number of bytes of archive data read when parsing a section
+        :param name: name of the section
+        :returns: total uncompressed size of the section's members
+        """
+        return sum(self.archive.getinfo(member).file_size
+                   for member in self.section_members(name))
+
+    def close(self):
+        """
+        Close the archive.  Sections that were not parsed yet are lost.
+        """
+        with self.lock:
+            self.archive.close()
 
 
 class DataLoaderFactory(object):
     """ Class that instantiates DataLoader objects """
 
-    def load_data(self, filename):
+    def load_data(self, filename, sections=None):
         """
         Load data from the appropriate DataLoader for given archive filename
+
+        The archive is left open so that sections which were not requested can
+        still be parsed when they are first used; call close() on the returned
+        DataLoader when it is no longer needed.
         :param filename: name of zip archive file containing execution data
-        :returns: data returned by pipeline.DataLoader.load_data()
+        :param sections: names of the sections to parse now, or None for all
+        :returns: DataLoader for the pipeline the execution data came from
         """
         # Open zip archive as ZipFile object
-        with ZipFile(filename, 'r') as archive:
+        archive = ZipFile(filename, 'r')
+        try:
             dl = self.data_loader(archive)
-            dl.load()
-            return dl
+            dl.load(sections)
+        except:
+            archive.close()
+            raise
+        return dl
 
     def data_loader(self, archive):
         """
@@ -69,6 +175,137 @@ class DataLoaderFactory(object):
         return pipe_factory.create(archive, parser)
 
 
+class DataLoaderThread(Thread):
+    """
+    Thread that opens an archive and parses its sections in the background
+
+    Sections are parsed one group at a time, in the order the groups are
+    given, so the caller can start using a group (e.g. show a tab) as soon as
+    it is ready.  The callbacks are run on the worker thread; GUI code must
+    pass them on to its main thread itself, for example with wx.CallAfter.
+
+    Callbacks, any of which may be None:
+        on_opened(dl) -- the archive was opened; dl is the DataLoader, which
+                         the caller may use until it calls close()
+        on_progress(sections_done, sections_total, bytes_done, bytes_total)
+                      -- a section has been parsed
+        on_group(index) -- all sections of groups[index] have been parsed
+        on_error(e) -- opening or parsing failed with exception e
+        on_finished() -- all groups have been parsed
+    None of them are run after cancel() has been called, except on_opened if
+    the archive was already open.
+
+    The DataLoader must be closed with close() on the thread rather than with
+    its own close(), which would wait for the section being parsed.
+    """
+
+    def __init__(self, filename, groups):
+        """
+        Create the thread; call start() to begin loading
+        :param filename: name of zip archive file containing execution data
+        :param groups: list of tuples of section names
+        """
+        super(DataLoaderThread, self).__init__(name='DataLoaderThread')
+        self.daemon = True
+
+        self.filename = filename
+        self.groups = groups
+        self.cancelled = Event()
+        # Guards dl, stopped and close_requested, so the DataLoader is closed
+        # exactly once, by whichever of close() and run() comes last
+        self.state_lock = Lock()
+        self.dl = None
+        self.stopped = False
+        self.close_requested = False
+
+        self.on_opened = None
+        self.on_progress = None
+        self.on_group = None
+        self.on_error = None
+        self.on_finished = None
+
+    def cancel(self):
+        """Stop loading once the section being parsed is done"""
+        self.cancelled.set()
+
+    def close(self):
+        """
+        Cancel loading and close the DataLoader, without waiting for the
+        section being parsed: if the thread is still running, it closes the
+        DataLoader itself when it stops
+        """
+        self.cancel()
+        with self.state_lock:
+            if not self.stopped:
+                self.close_requested = True
+                return
+            dl, self.dl = self.dl, None
+        if dl is not None:
+            dl.close()
+
+    def _notify(self, callback, *args):
+        """Run a callback unless loading was cancelled"""
+        if callback is not None and not self.cancelled.is_set():
+            callback(*args)
+
+    def run(self):
+        """Open the archive and parse every group of sections"""
+        try:
+            self._load()
+        finally:
+            with self.state_lock:
+                self.stopped = True
+                dl = self.dl if self.close_requested else None
+                if dl is not None:
+                    self.dl = None
+            if dl is not None:
+                dl.close()
+
+    def _load(self):
+        """Open the archive and parse every group of sections"""
+        try:
+            dl = DataLoaderFactory().load_data(self.filename, ())
+        except Exception as e:
+            self._notify(self.on_error, e)
+            return
+        with self.state_lock:
+            self.dl = dl
+        if self.cancelled.is_set():
+            # Nobody has seen the DataLoader yet, so it is ours to close
+            with self.state_lock:
+                self.close_requested = True
+            return
+        if self.on_opened is not None:
+            self.on_opened(dl)
+
+        try:
+            # Work out how much there is to do
+            names = []
+            for group in self.groups:
+                names.extend(name for name in group if name not in names)
+            sizes = dict((name, dl.section_size(name)) for name in names)
+            bytes_total = sum(sizes.itervalues())
+
+            done = []
+            bytes_done = 0
+            for index, group in enumerate(self.groups):
+                for name in group:
+                    if self.cancelled.is_set():
+                        return
+                    if name in done:
+                        continue
+                    getattr(dl, name)
+                    done.append(name)
+                    bytes_done += sizes[name]
+                    self._notify(self.on_progress, len(done), len(names),
+                                 bytes_done, bytes_total)
+                self._notify(self.on_group, index)
+        except Exception as e:
+            self._notify(self.on_error, e)
+            return
+        self._notify(self.on_finished)
+
+
 class UnknownPipelineError(Exception):
     """
     Exception for visualization files from unknown pipelines
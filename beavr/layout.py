@@ -0,0 +1,169 @@
+#
+# This file is part of BEAVr, https://github.com/theoryinpractice/beavr/, and is
+# Copyright (C) North Carolina State University, 2016. It is licensed under
+# the three-clause BSD license; see LICENSE.
+#
+
+import numpy as np
+
+
+def radial_layout(parents):
+    """
+    Lay out a forest radially, in time linear in its size
+
+    Every root is put at the origin, and every other vertex on a circle
+    around it whose radius is the vertex's depth.  Each vertex gets a wedge
+    of its parent's wedge in proportion to its number of leaves, and is put
+    in the middle of it, so subtrees never overlap.  The forest is handled
+    one level at a time with array operations.
+    :param parents: the index of every vertex's parent, or -1 for roots
+    :returns: array of shape (n, 2) of the positions of the vertices
+    """
+    parents = np.asarray(parents, dtype=np.intp).reshape(-1)
+    n = len(parents)
+    is_root = parents < 0
+
+    # The children of every vertex, as consecutive slices of one array
+    children = np.argsort(parents, kind='mergesort')[is_root.sum():]
+    child_counts = np.bincount(parents[~is_root], minlength=n)
+    child_starts = np.cumsum(child_counts) - child_counts
+
+    # Split the forest into levels, with siblings next to each other
+    levels = [np.flatnonzero(is_root)]
+    while True:
+        counts = child_counts[levels[-1]]
+        total = counts.sum()
+        if total == 0:
+            break
+        offsets = np.repeat(child_starts[levels[-1]] - (np.cumsum(counts) -
+                                                        counts), counts)
+        levels.append(children[np.arange(total) + offsets])
+
+    # Count the leaves under every vertex
+    leaves = (child_counts == 0).astype(float)
+    for level in reversed(levels[1:]):
+        np.add.at(leaves, parents[level], leaves[level])
+
+    # Share out the wedges, from the full circle around each root down
+    wedge_start = np.zeros(n)
+    wedge_size = np.zeros(n)
+    wedge_size[levels[0]] = 2 * np.pi
+    depth = np.zeros(n)
+    for index, level in enumerate(levels[1:], 1):
+        level_parents = parents[level]
+        # Leaves under the siblings before each vertex
+        before = np.cumsum(leaves[level]) - leaves[level]
+        first_sibling = np.r_[True, level_parents[1:] != level_parents[:-1]]
+        sibling_group = np.cumsum(first_sibling) - 1
+        before -= before[first_sibling][sibling_group]
+
+        unit = wedge_size[level_parents] / leaves[level_parents]
+        wedge_start[level] = wedge_start[level_parents] + before * unit
+        wedge_size[level] = leaves[level] * unit
+        depth[level] = index
+
+    angle = wedge_start + wedge_size / 2
+    return np.column_stack((depth * np.cos(angle), depth * np.sin(angle)))
+
+
+def fit_layouts(points, sizes, margin):
+    """
+    Re-center and scale the positions of several layouts to fit within a
+    margin of the edges of the unit square
+    :param points: array of shape (n, 2) of the positions of the vertices of
+                   all layouts, one layout after another
+    :param sizes: number of vertices in each layout; none may be empty
+    :param margin: space to leave on each side of the unit square
+    :returns: array of the new positions
+    """
+    sizes = np.asarray(sizes, dtype=np.intp)
+    starts = np.cumsum(sizes) - sizes
+    min_xy = np.minimum.reduceat(points, starts)
+    max_xy = np.maximum.reduceat(points, starts)
+    center_xy = min_xy + (max_xy - min_xy) / 2
+    # Layouts with no width or height are left unscaled in that direction
+    half_size = center_xy - min_xy
+    scale = np.ones_like(half_size)
+    scale[half_size != 0] = (0.5 - margin - 0.005) / half_size[half_size != 0]
+    return ((points - np.repeat(center_xy, sizes, axis=0)) *
+            np.repeat(scale, sizes, axis=0) + 0.5)
+
+
+def digraph_parents(forest):
+    """
+    Find the parents of the vertices of a forest stored as a DiGraph with
+    edges from vertices to their parents, such as a treedepth decomposition
+    :param forest: the DiGraph
+    :returns: dictionary mapping every vertex to its parent, or to None for
+              the roots
+    """
+    return dict((v, (forest.successors(v) or [None])[0]) for v in forest)
+
+
+def tree_layouts(trees, margin):
+    """
+    Lay out trees radially, each one within a margin of the edges of the
+    unit square
+    :param trees: list of dictionaries mapping every vertex of a tree to its
+                  parent, or to None for the root
+    :param margin: space to leave on each side of the unit square
+    :returns: list of dictionaries mapping every vertex to its position
+    """
+    trees = list(trees)
+    if not trees:
+        return []
+
+    vertices = [list(tree) for tree in trees]
+    parents = []
+    for tree, tree_vertices in zip(trees, vertices):
+        offset = len(parents)
+        index = dict((vertex, offset + i)
+                     for i, vertex in enumerate(tree_vertices))
+        parents.extend(-1 if tree[vertex] is None else index[tree[vertex]]
+                       for vertex in tree_vertices)
+
+    sizes = [len(tree_vertices) for tree_vertices in vertices]
+    points = fit_layouts(radial_layout(parents), sizes, margin).tolist()
+
+    layouts = []
+    start = 0
+    for tree_vertices, size in zip(vertices, sizes):
+        layouts.append(dict(zip(tree_vertices,
+                                map(tuple, points[start:start + size]))))
+        start += size
+    return layouts
+
+
+def shelf_pack(widths, heights):
+    """
+    Pack boxes onto shelves, filling a roughly square area, in time
+    O(k log k) for k boxes
+
+    Boxes are put on shelves from the tallest to the shortest, left to right,
+    and a new shelf is started below the last one whenever the next box
+    doesn't fit on it.  The top of the first shelf is at y = 0.
+    :param widths: width of each box
+    :param heights: height of each box
+    :returns: array of shape (k, 4) of the x_min, y_min, x_max and y_max of
+              each box, in the order they were given
+    """
+    widths = np.asarray(widths, dtype=float).reshape(-1)
+    heights = np.asarray(heights, dtype=float).reshape(-1)
+    boxes = np.zeros((len(widths), 4))
+    if not len(widths):
+        return boxes
+
+    shelf_width = max(widths.max(), np.sqrt(np.dot(widths, heights)))
+    x = 0.
+    top = 0.
+    shelf_height = 0.
+    for index in np.argsort(-heights, kind='mergesort'):
+        if x + widths[index] > shelf_width and x > 0:
+            x = 0.
+            top -= shelf_height
+        if x == 0:
+            # The first box of a shelf is its tallest
+            shelf_height = heights[index]
+        boxes[index] = (x, top - heights[index], x + widths[index], top)
+        x += widths[index]
+    return boxes
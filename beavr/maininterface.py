@@ -18,8 +18,8 @@ from beavr.concuss.stageinterface import (
     CountInterface,
     CombineInterface
 )
-from beavr.stageinterface import DummyStageInterface
-from beavr.dataloader import DataLoaderFactory, UnknownPipelineError
+from beavr.stageinterface import DummyStageInterface, PendingStageInterface
+from beavr.dataloader import DataLoaderThread, UnknownPipelineError
 
 class MainInterface(wx.Frame):
     """
@@ -42,6 +42,22 @@ class MainInterface(wx.Frame):
         self.CreateStatusBar()
 
         self.notebook = wx.Notebook(self, wx.NewId(), style=wx.BK_DEFAULT)
+        self.notebook.Bind(wx.EVT_NOTEBOOK_PAGE_CHANGED, self.OnPageChanged)
+
+        # DataLoader for the open archive, and the DataLoaderThread that
+        # opened it, which has to close it
+        self.dl = None
+        self.dl_loader = None
+        # DataLoaderThread for the archive being opened, if any
+        self.loader = None
+
+        # Every stage, in tab order, with the method creating its interface
+        self.stages = [
+            (ColorInterface, self._make_color_stage),
+            (DecomposeInterface, self._make_decompose_stage),
+            (CountInterface, self._make_count_stage),
+            (CombineInterface, self._make_combine_stage)
+        ]
 
         dummy = DummyStageInterface(self.notebook)
         self.add_tab(dummy)
@@ -60,6 +76,9 @@ class MainInterface(wx.Frame):
         fileMenu = wx.Menu()
         fitem = fileMenu.Append(wx.ID_OPEN, help='Open execution data')
         self.Bind(wx.EVT_MENU, self.OnOpen, fitem)
+        fitem = fileMenu.Append(wx.NewId(), '&Cancel Loading\tEsc',
+                                'Stop loading execution data')
+        self.Bind(wx.EVT_MENU, self.OnCancelLoading, fitem)
         fileMenu.Append(wx.NewId(), '&Config', 'Configure Pipeline Data')
         fitem = fileMenu.Append(wx.ID_EXIT, help='Quit application')
         self.Bind(wx.EVT_MENU, self.OnQuit, fitem)
@@ -123,6 +142,9 @@ class MainInterface(wx.Frame):
     def OnClose(self, e):
         """Close the main window"""
         self._save_geometry()
+        self.cancel_loading()
+        if self.dl is not None:
+            self.dl_loader.close()
         self.Destroy()
 
     def OnOpen(self, e):
@@ -140,52 +162,196 @@ class MainInterface(wx.Frame):
         # Destroy the dialog
         dlg.Destroy()
 
+    def load_file(self, filename):
+        """
+        Open an archive and show its stages
+
+        The archive is parsed by a DataLoaderThread.  The sections needed by
+        the visible tab are parsed first, and every tab appears as soon as all
+        of its sections are ready.
+        """
+        self.cancel_loading()
+
+        # Keep showing the same stage if one was already open
+        selection = max(self.notebook.GetSelection(), 0)
+        if selection >= len(self.stages):
+            selection = 0
+        self.load_order = [selection] + [i for i in range(len(self.stages))
+                                         if i != selection]
+
+        loader = DataLoaderThread(filename, [self.stages[i][0].sections
+                                             for i in self.load_order])
+        loader.on_opened = self._post(loader, self.on_loader_opened)
+        loader.on_progress = self._post(loader, self.on_loader_progress)
+        loader.on_group = self._post(loader, self.on_loader_group)
+        loader.on_error = self._post(loader, self.on_loader_error)
+        loader.on_finished = self._post(loader, self.on_loader_finished)
+        self.loader = loader
+        self.loading_name = os.path.basename(filename)
+
+        self.SetStatusText('Opening ' + self.loading_name)
+        loader.start()
+
+    def _post(self, loader, method):
+        """Wrap a loader callback so it runs on the main thread"""
+        return lambda *args: wx.CallAfter(method, loader, *args)
+
+    def cancel_loading(self):
+        """
+        Stop parsing the archive that is being loaded.  Tabs whose sections
+        weren't parsed yet are still added, and parse them when first shown.
+        """
+        if self.loader is not None:
+            self.loader.cancel()
+            if self.dl_loader is self.loader:
+                self.add_remaining_tabs()
+            self.loader = None
+            self.SetStatusText('Loading cancelled')
+
+    def on_loader_opened(self, loader, dl):
+        """Replace the old archive's tabs once the new archive is open"""
+        if loader is not self.loader:
+            # Loading was cancelled, so nobody wants this archive
+            loader.close()
+            return
+
+        # Forget the previous archive.  Its loader closes it once it is done
+        # parsing, so this never waits for it.
+        self.remove_all_tabs()
+        if self.dl is not None:
+            self.dl_loader.close()
+        self.dl = dl
+        self.dl_loader = loader
+        self.shown_stages = []
+
         # At this point, we might be using several extra megabytes of RAM, so
         # run garbage collection to clean up unused objects.
         gc.collect()
 
-    def load_file(self, filename):
-        dlf = DataLoaderFactory()
-        try:
-            self.dl = dlf.load_data(filename)
-        except (KeyError, BadZipfile) as e:
+        # Set the title bar
+        graph_name, pattern_name, config_name = self.dl.title_items
+        title_text = u"BEAVr \u2014 " + graph_name + ", " + pattern_name + " (" + config_name + ")"
+        self.SetTitle(title_text)
+
+    def on_loader_progress(self, loader, done, total, bytes_done,
+                           bytes_total):
+        """Show how far along loading is in the status bar"""
+        if loader is not self.loader:
+            return
+        self.SetStatusText('Loading {0}: {1} of {2} sections ({3} of {4} KB)'
+                           .format(self.loading_name, done, total,
+                                   bytes_done // 1024, bytes_total // 1024))
+
+    def on_loader_group(self, loader, index):
+        """Add the tab whose sections have just been parsed"""
+        if loader is not self.loader:
+            return
+        self.add_tab_for_stage(self.load_order[index], select=index == 0)
+        self.realize_page(self.notebook.GetSelection())
+
+    def add_tab_for_stage(self, stage, select=False):
+        """
+        Add the tab of a stage, to be built when it is first shown
+        :param stage: index of the stage in self.stages
+        :param select: whether to show the new tab
+        """
+        interface, factory = self.stages[stage]
+        # Keep the tabs in their usual order
+        position = len([s for s in self.shown_stages if s < stage])
+        self.shown_stages.append(stage)
+        page = PendingStageInterface(self.notebook, interface.name, factory)
+        self.notebook.InsertPage(position, page, page.name, select=select)
+
+    def add_remaining_tabs(self):
+        """Add the tabs of the stages whose groups weren't loaded"""
+        for stage in self.load_order:
+            if stage not in self.shown_stages:
+                self.add_tab_for_stage(stage)
+
+    def on_loader_error(self, loader, e):
+        """Tell the user that the archive or a tab could not be loaded"""
+        if loader is not self.loader:
+            return
+        self.loader = None
+        self.SetStatusText('')
+        if isinstance(e, UnknownPipelineError):
+            e_dlg = wx.MessageDialog(None, e.msg, 'Error', wx.ICON_ERROR)
+        elif self.dl_loader is loader:
+            print e
+            # The archive is open, and the groups come in order, so the
+            # failed group is the first one without a tab
+            stage = self.load_order[len(self.shown_stages)]
+            e_dlg = wx.MessageDialog(None, 'File does not contain valid ' +
+                                     'data for the ' +
+                                     self.stages[stage][0].name + ' tab',
+                                     'Error', wx.ICON_ERROR)
+            # The other tabs can still be parsed when they are shown
+            self.add_remaining_tabs()
+        else:
             print e
             e_dlg = wx.MessageDialog(None, 'File does not contain valid ' +
                                      'visualization data', 'Error',
                                      wx.ICON_ERROR)
+        e_dlg.ShowModal()
+
+    def on_loader_finished(self, loader):
+        """Clear the status bar once everything is loaded"""
+        if loader is not self.loader:
+            return
+        self.loader = None
+        self.SetStatusText('Loaded ' + self.loading_name)
+
+    def realize_page(self, index):
+        """Build the interface shown in the given tab if necessary"""
+        page = self.notebook.GetPage(index)
+        if not isinstance(page, PendingStageInterface):
+            return
+        try:
+            page.realize()
+        except (KeyError, BadZipfile) as e:
+            print e
+            e_dlg = wx.MessageDialog(None, 'File does not contain valid ' +
+                                     'data for the ' + page.name + ' tab',
+                                     'Error', wx.ICON_ERROR)
             e_dlg.ShowModal()
-        except UnknownPipelineError as e:
-            e_dlg = wx.MessageDialog(None, e.msg, 'Error', wx.ICON_ERROR)
-            e_dlg.ShowModal()
-        else:
-            # Set the title bar
-            graph_name, pattern_name, config_name = self.dl.title_items
-            title_text = u"BEAVr \u2014 " + graph_name + ", " + pattern_name + " (" + config_name + ")"
-            self.SetTitle(title_text)
-
-            colorStage = ColorInterface(self.notebook)
-            self.remove_all_tabs()
-            self.add_tab(colorStage)
-            colorStage.vis.set_graph(self.dl.graph, self.dl.colorings)
-
-            decomposeStage = DecomposeInterface(self.notebook, self.dl.graph,
-                    self.dl.pattern, self.dl.colorings[-1])
-            self.add_tab(decomposeStage)
-
-            countStage = CountInterface(self.notebook, self.dl.big_component,
-                    self.dl.pattern, self.dl.tdd, self.dl.table, self.dl.colorings[-1])
-            self.add_tab(countStage)
-
-            #TODO: change colorings
-            if self.dl.pattern.number_of_nodes() == 3:
-                colorings = [[0,1,0], [2,3,2],[0,1,2], [3, 4, 5]]
-            elif self.dl.pattern.number_of_nodes() == 4:
-                colorings = [[0, 1, 2, 3], [0, 1, 2, 5], [0, 1, 0, 2], [3, 4, 1, 3]]
-            colors = set(self.dl.colorings[-1])
-            combineStage = CombineInterface(self.notebook, self.dl.pattern,
-                                            colorings, colors, len(min(self.dl.counts_per_colorset.keys(), key=len)),
-                                            self.dl.counts_per_colorset)
-            self.add_tab(combineStage)
+
+    def _make_color_stage(self, parent):
+        """Create the Color tab for the current archive"""
+        colorStage = ColorInterface(parent)
+        colorStage.vis.set_graph(self.dl.graph, self.dl.colorings)
+        return colorStage
+
+    def _make_decompose_stage(self, parent):
+        """Create the Decompose tab for the current archive"""
+        return DecomposeInterface(parent, self.dl.graph, self.dl.pattern,
+                                  self.dl.colorings[-1])
+
+    def _make_count_stage(self, parent):
+        """Create the Count tab for the current archive"""
+        return CountInterface(parent, self.dl.big_component, self.dl.pattern,
+                              self.dl.tdd, self.dl.table, self.dl.colorings[-1],
+                              self.dl.tdd_layout)
+
+    def _make_combine_stage(self, parent):
+        """Create the Combine tab for the current archive"""
+        #TODO: change colorings
+        if self.dl.pattern.number_of_nodes() == 3:
+            colorings = [[0,1,0], [2,3,2],[0,1,2], [3, 4, 5]]
+        elif self.dl.pattern.number_of_nodes() == 4:
+            colorings = [[0, 1, 2, 3], [0, 1, 2, 5], [0, 1, 0, 2], [3, 4, 1, 3]]
+        colors = set(self.dl.colorings[-1])
+        return CombineInterface(parent, self.dl.pattern, colorings, colors,
+                                len(min(self.dl.counts_per_colorset.keys(), key=len)),
+                                self.dl.counts_per_colorset)
+
+    def OnPageChanged(self, e):
+        """Build the newly selected tab's interface on first view"""
+        self.realize_page(e.GetSelection())
+        e.Skip()
+
+    def OnCancelLoading(self, e):
+        """Stop loading execution data"""
+        self.cancel_loading()
 
     def OnQuit(self, e):
         """Quit the application"""
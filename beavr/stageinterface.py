@@ -79,6 +79,39 @@ class DummyStageInterface(StageInterface):
 
         self.tb.Realize()
 
+class PendingStageInterface(wx.Panel):
+    """
+    Placeholder tab for a StageInterface that has not been built yet.
+
+    Building an interface forces its DataLoader to parse every section the
+    interface needs, so the MainInterface adds a PendingStageInterface for each
+    tab and only realizes the ones the user actually looks at.
+    """
+
+    def __init__(self, parent, name, factory):
+        """
+        Create an empty placeholder
+        :param name: tab name of the interface that will be built
+        :param factory: callable taking a parent window and returning the
+                        interface to show in this tab
+        """
+        super(PendingStageInterface, self).__init__(parent)
+
+        self.name = name
+        self.factory = factory
+        self.interface = None
+
+        self.sizer = wx.BoxSizer(wx.HORIZONTAL)
+        self.SetSizer(self.sizer)
+
+    def realize(self):
+        """Build the interface if it hasn't been built yet, and return it"""
+        if self.interface is None:
+            self.interface = self.factory(self)
+            self.sizer.Add(self.interface, 1, wx.EXPAND)
+            self.Layout()
+        return self.interface
+
 class StageVisualizer(wx.Panel):
     """Base class for visualizing a particular stage of a pipeline"""
 
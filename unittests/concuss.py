@@ -4,11 +4,20 @@
 # the three-clause BSD license; see LICENSE.
 #
 
+import time
 import unittest
 
 import networkx as nx
+import numpy as np
 
 from beavr.concuss import visualizerbackend
+from beavr.concuss.dataloader import DPTable, parse_dp_table
+
+try:
+    import pygraphviz
+except ImportError:
+    pygraphviz = None
+
 
 class TestDecompositionGenerator(unittest.TestCase):
 
@@ -49,6 +58,124 @@ class TestDecompositionGenerator(unittest.TestCase):
         # Assert that it has no edges
         self.assertEquals(comps[1].edges(), [], msg='Wrong edge set')
 
+    def test_get_connected_components_isomorphic(self):
+        # Paths colored 0-1-0, 0-0-1 and 1-0-0
+        graph = nx.Graph([(0, 1), (1, 2), (3, 4), (4, 5), (6, 7), (7, 8)])
+        coloring = [0, 1, 0, 0, 0, 1, 1, 0, 0]
+        comps = visualizerbackend.DecompositionGenerator(graph, coloring
+                ).get_connected_components({0, 1})
+        # The last two paths are the same up to isomorphism, but the first
+        # one isn't, even though it has the same colors
+        self.assertEquals([sorted(comp.nodes()) for comp in comps],
+                [[0, 1, 2], [3, 4, 5]], msg='Wrong components')
+        self.assertEquals([comp.occ for comp in comps], [1, 2],
+                msg='Wrong numbers of occurrences')
+        # Make the last path 0-1-0 instead
+        coloring[6:9] = [0, 1, 0]
+        comps = visualizerbackend.DecompositionGenerator(graph, coloring
+                ).get_connected_components({0, 1})
+        self.assertEquals([comp.occ for comp in comps], [2, 1],
+                msg='Wrong numbers of occurrences')
+
+    def test_get_connected_components_toggle(self):
+        # Removing color 1 splits the component on {0, 1, 2, 3} in two
+        self.decomp_generator.get_connected_components({0, 1, 2, 3})
+        comps = self.decomp_generator.get_connected_components({0, 2, 3})
+        self.assertEquals([comp.nodes() for comp in comps], [[0], [2, 3]],
+                msg='Wrong vertex sets')
+        # Adding color 4 merges into the component containing vertex 3
+        comps = self.decomp_generator.get_connected_components({0, 2, 3, 4})
+        self.assertEquals([comp.nodes() for comp in comps], [[0], [2, 3, 4]],
+                msg='Wrong vertex sets')
+        self.assertEquals(sorted(comps[1].edges()), [(2, 3), (3, 4)],
+                msg='Wrong edge set')
+
+    def test_color_index(self):
+        self.decomp_generator = visualizerbackend.DecompositionGenerator(
+                self.graph, [0, 1, 0, 1, 2, 2])
+        self.assertEquals(self.decomp_generator.color_vertices(1), [1, 3],
+                msg='Wrong vertices')
+        self.assertEquals(self.decomp_generator.color_vertices(3), [],
+                msg='Wrong vertices')
+        self.assertEquals(
+                sorted(self.decomp_generator.color_set_vertices({0, 2})),
+                [0, 2, 4, 5], msg='Wrong vertices')
+        self.assertEquals(self.decomp_generator.color_pair_edges,
+                {(0, 1): 3, (1, 1): 1, (1, 2): 1, (2, 2): 1},
+                msg='Wrong edge counts')
+
+    def test_get_decomposition(self):
+        comps, occurrences, layouts, boxes = \
+                self.decomp_generator.get_decomposition({0, 1, 5})
+        self.assertEquals([comp.nodes() for comp in comps], [[0, 1], [5]],
+                msg='Wrong vertex sets')
+        self.assertEquals(occurrences, [1, 1], msg='Wrong occurrences')
+        self.assertEquals(len(layouts), 2, msg='Wrong number of layouts')
+        for layout, box in zip(layouts, boxes):
+            for x, y in layout.itervalues():
+                self.assertTrue(box[0] <= x <= box[2] and box[1] <= y <= box[3],
+                        msg='Vertex outside of its bounding box')
+        # Going back to a color set reuses its decomposition
+        self.decomp_generator.get_decomposition({0, 1, 2})
+        self.assertTrue(self.decomp_generator.get_decomposition({0, 1, 5})[2]
+                is layouts, msg='Decomposition not cached')
+
+    def test_get_statistics(self):
+        self.decomp_generator = visualizerbackend.DecompositionGenerator(
+                self.graph, [0, 1, 0, 1, 2, 2])
+        self.assertEquals(self.decomp_generator.get_statistics({0, 1, 2}),
+                {'components': 1, 'sizes': {6: 1}, 'classes': 1})
+        # Components {0}, {2} and {4, 5}, the first two the same up to
+        # isomorphism
+        self.assertEquals(self.decomp_generator.get_statistics({0, 2}),
+                {'components': 3, 'sizes': {1: 2, 2: 1}, 'classes': 2})
+
+    def test_get_color_set_statistics(self):
+        serial = self.decomp_generator.get_color_set_statistics(3, 1)
+        self.assertEquals(len(serial), 20, msg='Wrong number of color sets')
+        self.assertEquals(serial[0], ((0, 1, 2),
+                {'components': 1, 'sizes': {3: 1}, 'classes': 1}))
+        parallel = self.decomp_generator.get_color_set_statistics(3, 2)
+        self.assertEquals(parallel, serial,
+                msg='Parallel statistics differ from serial ones')
+
+    def test_prefetcher(self):
+        prefetcher = visualizerbackend.DecompositionPrefetcher(
+                self.decomp_generator)
+        prefetcher.start()
+        prefetcher.prefetch({0, 1})
+        expected = [frozenset({0, 1}) ^ {color} for color in range(6)]
+        cache = self.decomp_generator.cache
+        for i in range(100):
+            if all(color_set in cache for color_set in expected):
+                break
+            time.sleep(0.05)
+        prefetcher.cancel()
+        prefetcher.join(5)
+        self.assertTrue(all(color_set in cache for color_set in expected),
+                msg='Neighboring color sets not prefetched')
+        self.assertFalse(prefetcher.is_alive(), msg='Prefetcher not stopped')
+
+    def test_get_underlying_tree(self):
+        tree = self.decomp_generator.get_underlying_tree(self.graph)
+        self.assertEquals(tree.root, 0, msg='Wrong root')
+        self.assertEquals(sorted(tree.edges()),
+                [(0, 1), (1, 2), (2, 3), (3, 4), (4, 5)], msg='Wrong edge set')
+        # Vertices 0 and 5 share a color, so the tree is rooted at vertex 1
+        self.decomp_generator.coloring = [0, 1, 2, 3, 4, 0]
+        tree = self.decomp_generator.get_underlying_tree(self.graph)
+        self.assertEquals(tree.root, 1, msg='Wrong root')
+        self.assertEquals(sorted(tree.edges()),
+                [(0, 1), (1, 2), (2, 3), (3, 4), (4, 5)], msg='Wrong edge set')
+
+    def test_get_underlying_tree_deep(self):
+        # A path with no repeated colors has a tree as deep as the path
+        path = nx.path_graph(1500)
+        tree = visualizerbackend.DecompositionGenerator(path, range(1500)
+                ).get_underlying_tree(path)
+        self.assertEquals(tree.number_of_edges(), 1499,
+                msg='Wrong number of edges')
+
     def test_get_tree_layout(self):
         # Get a tree layout of the whole original graph
         layout = self.decomp_generator.get_tree_layout(self.graph)
@@ -63,24 +190,202 @@ class TestDecompositionGenerator(unittest.TestCase):
             self.assertTrue(point[1] <= 0.95,
                     msg='point[1] too large ({0})'.format(point[1]))
 
+    @unittest.skipUnless(pygraphviz, 'pygraphviz is not installed')
+    def test_get_graphviz_layouts(self):
+        trees = [self.decomp_generator.get_underlying_tree(self.graph),
+                 self.decomp_generator.get_underlying_tree(
+                     nx.Graph([(7, 8)]))]
+        layouts = self.decomp_generator.get_graphviz_layouts(trees)
+        self.assertEquals([sorted(layout) for layout in layouts],
+                [range(6), [7, 8]], msg='Wrong vertices')
+        margin = self.decomp_generator.layout_margin
+        for layout in layouts:
+            for x, y in layout.itervalues():
+                self.assertTrue(margin <= x <= 1 - margin and
+                                margin <= y <= 1 - margin,
+                        msg='Position out of bounds')
+
     def tearDown(self):
         """Cleans up after tests are run"""
 
 
+class TestDecompositionCache(unittest.TestCase):
+
+    def test_eviction(self):
+        def entry(size):
+            return ([nx.path_graph(size)], [1], [{}])
+        # Room for 25 vertices and the 24 edges between them
+        cache = visualizerbackend.DecompositionCache(
+                25 * cache_bytes(1, 0) + 24 * cache_bytes(0, 1))
+        cache.put(frozenset([0]), entry(10))
+        cache.put(frozenset([1]), entry(10))
+        # Using {0} makes {1} the least recently used
+        self.assertTrue(cache.get(frozenset([0])) is not None)
+        cache.put(frozenset([2]), entry(10))
+        self.assertTrue(frozenset([0]) in cache)
+        self.assertFalse(frozenset([1]) in cache)
+        self.assertTrue(frozenset([2]) in cache)
+        # Entries bigger than the cache are still kept until the next one
+        cache.put(frozenset([3]), entry(30))
+        self.assertEquals(cache.entries.keys(), [frozenset([3])])
+
+def cache_bytes(vertices, edges):
+    """Estimated size of vertices and edges in a DecompositionCache"""
+    return (vertices * visualizerbackend.DecompositionCache.vertex_bytes +
+            edges * visualizerbackend.DecompositionCache.edge_bytes)
+
+
+class TestTDDIndex(unittest.TestCase):
+
+    def setUp(self):
+        """ Sets up the necessary objects to run"""
+        # 0 is the root, with children 1 and 2, and 3 and 4 are under 1
+        self.index = visualizerbackend.TDDIndex(
+                nx.DiGraph([(1, 0), (2, 0), (3, 1), (4, 1)]))
+
+    def test_root_path(self):
+        self.assertEquals(self.index.root_path(0), [])
+        self.assertEquals(self.index.root_path(4), [0, 1])
+        self.assertEquals(self.index.depth, {0: 0, 1: 1, 2: 1, 3: 2, 4: 2})
+
+    def test_subforest(self):
+        self.assertEquals(sorted(self.index.subforest([1])), [1, 3, 4])
+        # Overlapping subtrees are only listed once
+        self.assertEquals(sorted(self.index.subforest([3, 1, 2])),
+                [1, 2, 3, 4])
+
+    def test_is_ancestor(self):
+        self.assertTrue(self.index.is_ancestor(0, 3))
+        self.assertTrue(self.index.is_ancestor(1, 1))
+        self.assertFalse(self.index.is_ancestor(2, 3))
+        self.assertFalse(self.index.is_ancestor(3, 1))
+
+    def test_deep(self):
+        # A path is indexed without running out of stack
+        index = visualizerbackend.TDDIndex(
+                nx.DiGraph([(v + 1, v) for v in range(5000)]))
+        self.assertEquals(len(index.root_path(5000)), 5000)
+        self.assertEquals(len(index.subforest([0])), 5001)
+
+
 class TestCountGenerator(unittest.TestCase):
 
     def setUp(self):
         """ Sets up the necessary objects to run"""
-        # TODO
+        # A path, decomposed with 1 as the root, 0 and 2 as its children and
+        # 3 under 2
+        graph = nx.path_graph(4)
+        tdd = nx.DiGraph([(0, 1), (2, 1), (3, 2)])
+        pattern = nx.path_graph(3)
+        # The middle of the pattern is on the boundary, mapped to 1, and one
+        # of its ends is in the subforest under 2
+        self.k_pattern = [1, [1, 2], {1: 0}]
+        # with an entry with no boundary, which is never picked, next to it
+        dptable = {(2,): [self.k_pattern], (2, 3): [[1, [], {}]]}
+        self.CG = visualizerbackend.CountGenerator(graph, pattern, tdd,
+                dptable, [0, 1, 2, 0], 'brewer')
+
+    def test_match_k_pattern(self):
+        matches = list(self.CG.match_k_pattern(self.k_pattern, [1], {2, 3}))
+        self.assertEquals(matches, [{0: 0, 1: 1, 2: 2}],
+                msg='Wrong copies of the pattern')
+        # The end of the pattern outside of the subforest has nowhere to go
+        self.assertEquals(list(self.CG.match_k_pattern([1, [0, 1], {0: 0}],
+                [1], {2, 3})), [], msg='Copy not in the right places')
+
+    def test_get_motifs_for_k_pattern(self):
+        motifs = self.CG.get_motifs_for_k_pattern(self.k_pattern, (2,), [1])
+        self.assertEquals([sorted(motif.edges()) for motif in motifs],
+                [[(0, 1), (1, 2)]], msg='Wrong motifs')
+
+    def make_generator(self, table_text):
+        """Make a CountGenerator like self.CG with the given DP table"""
+        return visualizerbackend.CountGenerator(self.CG.graph,
+                self.CG.pattern, self.CG.tdd,
+                DPTable(**parse_dp_table(table_text)), self.CG.coloring,
+                'brewer')
 
-        #self.CSG = visualizerbackend.CountGenerator(graph, tdd, k_patterns,\
-        #                                            motifs, coloring)
+    def test_index_patterns(self):
+        # The root path of 2 is [1], so only label 0 fits on it
+        CG = self.make_generator('[2] {\n'
+                                 '\t1; [1]; [1:1]\n'
+                                 '\t1; [1, 2]; [1:0]\n'
+                                 '}\n'
+                                 '[2, 3] {\n'
+                                 '\t1; []; []\n'
+                                 '}\n')
+        self.assertEquals(CG.pattern_entries.tolist(), [1])
+        self.assertEquals(CG.k_patterns, [self.k_pattern])
+        self.assertEquals(CG.vertices_list, [(2,)])
+
+    def test_sample_patterns(self):
+        CG = self.make_generator('[2] {\n' +
+                                 ''.join('\t{0}; [1]; [1:0]\n'.format(count)
+                                         for count in range(10)) +
+                                 '}\n')
+        for count in range(12):
+            counts = [k_pat[0] for _, k_pat in CG.sample_patterns(count)]
+            self.assertEquals(len(counts), min(count, 10))
+            self.assertEquals(len(set(counts)), len(counts),
+                    msg='k-pattern chosen twice')
+
+    def test_sample_blocks(self):
+        # Tables that aren't indexed are sampled a block at a time, and
+        # sampling stops even though only one k-pattern can be displayed
+        self.assertTrue(self.CG.pattern_entries is None)
+        self.assertEquals(self.CG.sample_patterns(3),
+                [((2,), self.k_pattern)])
+
+    @unittest.skipUnless(pygraphviz, 'pygraphviz is not installed')
+    def test_get_graphviz_layout(self):
+        self.CG.use_graphviz = True
+        layout = self.CG.get_layout(self.CG.graph)
+        self.assertEquals(sorted(layout), [0, 1, 2, 3], msg='Wrong vertices')
+        margin = self.CG.layout_margin
+        for x, y in layout.itervalues():
+            self.assertTrue(margin <= x <= 1 - margin and
+                            margin <= y <= 1 - margin,
+                    msg='Position out of bounds')
 
     def test_get_layouts(self):
-        pass
+        layouts = self.CG.get_layouts()
+        # There is only one k-pattern to show
+        self.assertEquals(len(layouts), 1)
+        for x_offset, column in enumerate(layouts):
+            # The pattern, the k-pattern in the component, and one copy
+            self.assertEquals([sorted(layout) for layout in column],
+                    [[0, 1, 2], [0, 1, 2, 3], [0, 1, 2, 3]])
+            # The component panels are the same layout, one under the other
+            for vertex, (x, y) in column[1].iteritems():
+                self.assertTrue(x_offset <= x <= x_offset + 1 and -1 <= y <= 0,
+                        msg='Position out of bounds')
+                self.assertAlmostEquals(column[2][vertex][0], x)
+                self.assertAlmostEquals(column[2][vertex][1], y - 1)
+
+    def test_given_layout(self):
+        # Layouts of any size are fit to the panels
+        CG = visualizerbackend.CountGenerator(self.CG.graph, self.CG.pattern,
+                self.CG.tdd, self.CG.dptable, self.CG.coloring, 'brewer',
+                {0: (-10, 0), 1: (0, 10), 2: (10, 0), 3: (20, -10)})
+        x, y = CG.get_layouts()[0][1][1]
+        self.assertAlmostEquals(x, 0.5 - 0.345 / 3)
+        self.assertAlmostEquals(y, -1 + 0.5 + 0.345)
 
     def test_get_attributes(self):
-        pass
+        column = self.CG.get_attributes()[0]
+        self.assertEquals(len(column), 3)
+        # The k-pattern's boundary is 1, and its subforest is 2 and 3
+        header = column[1]
+        self.assertEquals(np.asarray(header['node_color']).tolist(),
+                [[0.8, 0.8, 0.8], [0, 0, 0], [1, 1, 1], [1, 1, 1]])
+        self.assertEquals(list(header['linewidths']), [0.5, 1, 1, 1])
+        self.assertEquals(header['labels'], {1: 0})
+        # The copy of the pattern is 0, 1 and 2
+        motif = column[2]
+        self.assertEquals(list(motif['node_size']), [300, 600, 300, 150])
+        self.assertEquals(list(motif['linewidths']), [3, 3, 3, 1])
+        self.assertEquals(list(motif['width']), [3, 3, 1])
+        self.assertEquals(motif['style'], ['solid', 'solid', 'dashed'])
 
     def tearDown(self):
         """Cleans up after tests are run"""
@@ -120,6 +425,8 @@ class TestCombineSetGenerator(unittest.TestCase):
 
 
 suite = unittest.TestLoader().loadTestsFromTestCase(TestDecompositionGenerator)
+suite = unittest.TestLoader().loadTestsFromTestCase(TestTDDIndex)
+suite = unittest.TestLoader().loadTestsFromTestCase(TestCountGenerator)
 suite = unittest.TestLoader().loadTestsFromTestCase(TestCombineSetGenerator)
 
 if __name__ == '__main__':
@@ -0,0 +1,376 @@
+#
+# This file is part of BEAVr, https://github.com/theoryinpractice/beavr/, and is
+# Copyright (C) North Carolina State University, 2016. It is licensed under
+# the three-clause BSD license; see LICENSE.
+#
+
+import unittest
+import os.path as path
+import shutil
+import tempfile
+import time
+from StringIO import StringIO
+from threading import Event
+from zipfile import ZipFile
+
+import numpy as np
+
+from beavr.dataloader import DataLoaderFactory, DataLoaderThread
+from beavr.concuss.dataloader import (
+    ColoringHistory,
+    DPTable,
+    IndexedDPTable,
+    parse_coloring,
+    parse_dp_table,
+    parse_edgelist,
+    read_gml,
+    read_xml_edges
+)
+
+testing_dir = path.join(path.dirname(path.abspath(__file__)), '..', 'testing')
+
+def copy_archive(name, directory):
+    """Copy a test archive, so its cache isn't written into the source tree"""
+    filename = path.join(directory, path.basename(name))
+    shutil.copy(path.join(testing_dir, name), filename)
+    return filename
+
+class TestConcussDataLoader(unittest.TestCase):
+
+    def setUp(self):
+        """ Sets up the necessary objects to run"""
+        self.tmp_dir = tempfile.mkdtemp()
+        self.filename = copy_archive('concuss/karate_p4.zip', self.tmp_dir)
+        self.dl = DataLoaderFactory().load_data(self.filename, ())
+
+    def test_lazy_sections(self):
+        # Nothing should be parsed until it is asked for
+        for name in self.dl.sections:
+            self.assertFalse(self.dl.is_loaded(name),
+                    msg='Section {0} parsed too early'.format(name))
+        # Accessing a section parses only that section
+        graph = self.dl.graph
+        self.assertTrue(self.dl.is_loaded('graph'))
+        self.assertFalse(self.dl.is_loaded('table'))
+        # Sections are parsed only once
+        self.assertIs(self.dl.graph, graph)
+
+    def test_load_sections(self):
+        self.dl.load(('colorings', 'tdd'))
+        self.assertTrue(self.dl.is_loaded('colorings'))
+        self.assertTrue(self.dl.is_loaded('tdd'))
+        self.assertFalse(self.dl.is_loaded('counts_per_colorset'))
+
+    def test_sections(self):
+        self.assertEquals(self.dl.title_items,
+                ('karate.txt', 'path4.txt', 'inex.cfg'))
+        self.assertEquals(self.dl.graph.number_of_nodes(), 34)
+        self.assertEquals(self.dl.graph.number_of_edges(), 78)
+        self.assertEquals(self.dl.pattern.number_of_nodes(), 4)
+        self.assertEquals(self.dl.colorings.shape, (5, 34))
+        self.assertEquals(self.dl.colorings[-1].dtype, np.int32)
+        self.assertEquals(len(self.dl.table), 39)
+        self.assertEquals(self.dl.tdd.number_of_edges(), 22)
+        self.assertEquals(sorted(self.dl.tdd_layout), sorted(self.dl.tdd))
+        self.assertEquals(len(self.dl.counts_per_colorset), 210)
+
+    def test_cache(self):
+        # The first load parses the archive and fills the cache
+        self.dl.load()
+        # The second load must come from the cache and give the same data
+        dl = DataLoaderFactory().load_data(self.filename, ())
+        try:
+            for name in ('graph', 'colorings', 'big_component', 'table',
+                         'tdd', 'tdd_layout'):
+                self.assertTrue(dl.cache.load(name) is not None,
+                        msg='Section {0} not cached'.format(name))
+            self.assertEquals(sorted(dl.graph.edges()),
+                              sorted(self.dl.graph.edges()))
+            self.assertEquals(sorted(dl.big_component.edges()),
+                              sorted(self.dl.big_component.edges()))
+            self.assertEquals(sorted(dl.tdd.edges()),
+                              sorted(self.dl.tdd.edges()))
+            self.assertEquals(dl.tdd_layout, self.dl.tdd_layout)
+            for cached, parsed in zip(dl.colorings, self.dl.colorings):
+                self.assertTrue(np.array_equal(cached, parsed))
+            self.assertEquals(sorted(dl.table.keys()),
+                              sorted(self.dl.table.keys()))
+            for vertices in dl.table:
+                self.assertEquals(dl.table[vertices], self.dl.table[vertices])
+        finally:
+            dl.close()
+
+    def test_indexed_table(self):
+        table = self.dl.table
+        # Force reading the table from disk
+        self.dl.indexed_table_size = 0
+        del self.dl.__dict__['table']
+        indexed = self.dl.table
+        self.assertTrue(isinstance(indexed, IndexedDPTable))
+        self.assertEquals(sorted(indexed.keys()), sorted(table.keys()))
+        for vertices in table:
+            self.assertEquals(indexed[vertices], table[vertices])
+        # The index is kept in the cache
+        self.assertTrue(self.dl.cache.load('dp_index') is not None)
+
+    def test_cache_invalidation(self):
+        self.dl.load(('graph',))
+        self.dl.close()
+        # Changing the archive must throw away the cached sections
+        with ZipFile(self.filename, 'a') as archive:
+            archive.writestr('extra.txt', 'extra')
+        self.dl = DataLoaderFactory().load_data(self.filename, ())
+        self.assertTrue(self.dl.cache.load('graph') is None)
+        self.assertEquals(self.dl.graph.number_of_edges(), 78)
+
+    def test_damaged_cache(self):
+        # A cached section missing its arrays is parsed again and recached
+        self.dl.cache.store('graph', {'unexpected': np.zeros(3)})
+        self.assertEquals(self.dl.graph.number_of_edges(), 78)
+        self.assertEquals(sorted(self.dl.cache.load('graph')),
+                          ['edges', 'nodes'])
+
+    def tearDown(self):
+        """Cleans up after tests are run"""
+        self.dl.close()
+        shutil.rmtree(self.tmp_dir)
+
+
+class TestParsers(unittest.TestCase):
+
+    def test_parse_coloring(self):
+        nodes, colors = parse_coloring('0: 3\n2: 1\n1:4\n')
+        self.assertEquals(nodes.tolist(), [0, 2, 1])
+        self.assertEquals(colors.tolist(), [3, 1, 4])
+        # Lines without a colon are ignored
+        nodes, colors = parse_coloring('# coloring\n0: 3\n\n2: 1\n')
+        self.assertEquals(nodes.tolist(), [0, 2])
+        self.assertEquals(colors.tolist(), [3, 1])
+
+    def test_parse_edgelist(self):
+        self.assertEquals(parse_edgelist('0 1\n1\t2\n').tolist(),
+                          [[0, 1], [1, 2]])
+        self.assertEquals(parse_edgelist('# comment\n\n0 1\n  \n2 3')
+                          .tolist(), [[0, 1], [2, 3]])
+        self.assertEquals(parse_edgelist('').shape, (0, 2))
+        self.assertRaises(ValueError, parse_edgelist, '0 1\n2 3 4\n')
+
+    def test_parse_dp_table(self):
+        table = DPTable(**parse_dp_table('[0] {\n'
+                                         '\t1; []; []\n'
+                                         '\t144; [0, 1, 2, 3]; []\n'
+                                         '}\n'
+                                         '[3, 33] {\n'
+                                         '\t3; [0, 1]; [1:0]\n'
+                                         '\t2; [2]; [2:0, 3:1]\n'
+                                         '}\n'
+                                         '[5] {\n'
+                                         '}\n'))
+        self.assertEquals(len(table), 3)
+        self.assertEquals(sorted(table.keys()), [(0,), (3, 33), (5,)])
+        self.assertEquals(table[(0,)], [[1, [], {}], [144, [0, 1, 2, 3], {}]])
+        self.assertEquals(table[(3, 33)], [[3, [0, 1], {1: 0}],
+                                           [2, [2], {2: 0, 3: 1}]])
+        self.assertEquals(table[(5,)], [])
+        self.assertTrue((3, 33) in table)
+        self.assertFalse((33, 3) in table)
+        # Entries can be found and summarized without building them
+        self.assertEquals(table.max_boundary_labels().tolist(),
+                          [-1, -1, 0, 1])
+        self.assertEquals([table.entry_block(index) for index in range(4)],
+                          [0, 0, 1, 1])
+        self.assertEquals(table.block_key(1), (3, 33))
+
+    def test_parse_dp_table_huge_counts(self):
+        huge = 2**70
+        table = DPTable(**parse_dp_table('[0] {\n'
+                                         '\t{0}; [0]; [0:0]\n'
+                                         '\t1; [1]; []\n'
+                                         '}\n'.replace('{0}', str(huge))))
+        self.assertEquals(table[(0,)], [[huge, [0], {0: 0}], [1, [1], {}]])
+
+    def test_read_gml(self):
+        graph = read_gml(StringIO('Creator "id 9 ]"\n'
+                                  'graph [\n'
+                                  '  directed 0\n'
+                                  '  node [ id 1 label "node [ id 7 ]" ]\n'
+                                  '  node [\n'
+                                  '    id -2\n'
+                                  '    graphics [ x 1.5 id 8 ]\n'
+                                  '  ]\n'
+                                  '  node[id 3]\n'
+                                  '  edge [ source 1 target -2 value 0.5 ]\n'
+                                  '  edge [ target 3 source -2 ]\n'
+                                  '  edge [ source 3 ]\n'
+                                  ']\n'))
+        self.assertEquals(sorted(graph.nodes()), [-2, 1, 3])
+        self.assertEquals(sorted(sorted(edge) for edge in graph.edges()),
+                          [[-2, 1], [-2, 3]])
+        self.assertEquals(read_gml(StringIO('')).number_of_nodes(), 0)
+
+    def test_read_xml_edges(self):
+        graphml = ('<?xml version="1.0"?>'
+                   '<graphml xmlns="http://graphml.graphdrawing.org/xmlns">'
+                   '<graph edgedefault="undirected">'
+                   '<node id="1"/><node id="2"/><node id="3"/>'
+                   '<edge source="1" target="2"><data key="w">1</data></edge>'
+                   '<edge source="2" target="3"/>'
+                   '<edge source="3" target="1"/>'
+                   '</graph></graphml>')
+        gexf = graphml.replace('graphml', 'g:gexf').replace('<edge', '<g:edge')
+        gexf = gexf.replace('xmlns=', 'xmlns:g=').replace('</edge', '</g:edge')
+        for text in graphml, gexf:
+            graph = read_xml_edges(StringIO(text), batch_size=2)
+            self.assertEquals(sorted(sorted(edge) for edge in graph.edges()),
+                              [[1, 2], [1, 3], [2, 3]])
+
+    def test_make_index(self):
+        filename = path.join(tempfile.mkdtemp(), 'dp_table.txt')
+        try:
+            with open(filename, 'w') as table_file:
+                table_file.write('[0] {\n\t1; []; []\n}\n'
+                                 '[3, 33] {\n\t3; [0, 1]; [1:0]\n}\n')
+            index = IndexedDPTable.make_index(filename)
+            self.assertEquals(index['block_starts'].tolist(), [0, 19, 49])
+            table = IndexedDPTable(filename, **index)
+            self.assertEquals(table[(3, 33)], [[3, [0, 1], {1: 0}]])
+            table.close()
+            # Empty tables work too
+            open(filename, 'w').close()
+            table = IndexedDPTable(filename,
+                                   **IndexedDPTable.make_index(filename))
+            self.assertEquals(len(table), 0)
+        finally:
+            shutil.rmtree(path.dirname(filename))
+
+
+class TestColoringHistory(unittest.TestCase):
+
+    def setUp(self):
+        """ Sets up the necessary objects to run"""
+        self.colorings = [[0, 1, 2, 0], [0, 1, 3, 0], [0, 1, 3, 0, 4],
+                          [2, 1, 3, 1, 4]]
+        steps = [(np.arange(len(c)), np.array(c)) for c in self.colorings]
+        self.history = ColoringHistory.from_steps(steps)
+
+    def test_differences(self):
+        self.assertEquals(self.history.base.tolist(), [0, 1, 2, 0])
+        self.assertEquals(self.history.offsets.tolist(), [0, 0, 1, 2, 4])
+        self.assertEquals(self.history.nodes.tolist(), [2, 4, 0, 3])
+
+    def test_getitem(self):
+        self.assertEquals(len(self.history), 4)
+        self.assertEquals(self.history.shape, (4, 5))
+        # Go backwards and forwards, and jump around
+        for index in (3, 2, 1, 0, 1, 3, -1, -4):
+            self.assertEquals(self.history[index].tolist()[:len(self.colorings[index])],
+                              self.colorings[index])
+        # Vertices missing from the first coloring have color 0
+        self.assertEquals(self.history[0].tolist(), [0, 1, 2, 0, 0])
+        self.assertRaises(IndexError, lambda: self.history[4])
+
+    def test_cache_size(self):
+        self.history.cache_size = 2
+        list(self.history)
+        self.assertEquals(self.history.materialized.keys(), [2, 3])
+
+
+class TestDataLoaderThread(unittest.TestCase):
+
+    def setUp(self):
+        """ Sets up the necessary objects to run"""
+        self.tmp_dir = tempfile.mkdtemp()
+        self.filename = copy_archive('concuss/karate_p4.zip', self.tmp_dir)
+        self.events = []
+        self.dl = None
+
+    def start_loader(self, filename, groups):
+        loader = DataLoaderThread(filename, groups)
+        loader.on_opened = self.on_opened
+        loader.on_progress = lambda *args: self.events.append(('progress',) + args)
+        loader.on_group = lambda index: self.events.append(('group', index))
+        loader.on_error = lambda e: self.events.append(('error', e))
+        loader.on_finished = lambda: self.events.append(('finished',))
+        loader.start()
+        return loader
+
+    def on_opened(self, dl):
+        self.dl = dl
+        self.events.append(('opened',))
+
+    def test_load_groups(self):
+        loader = self.start_loader(self.filename,
+                [('graph', 'colorings'), ('colorings', 'tdd')])
+        loader.join()
+        # Shared sections are only counted once
+        self.assertEquals([e[:3] for e in self.events], [('opened',),
+                ('progress', 1, 3), ('progress', 2, 3), ('group', 0),
+                ('progress', 3, 3), ('group', 1), ('finished',)])
+        # Byte counts grow up to the total
+        self.assertEquals(self.events[4][3], self.events[4][4])
+        self.assertTrue(self.dl.is_loaded('tdd'))
+        self.assertFalse(self.dl.is_loaded('table'))
+
+    def test_cancel(self):
+        loader = DataLoaderThread(self.filename, [('graph',), ('table',)])
+        # Cancel as soon as the archive is open
+        def on_opened(dl):
+            self.dl = dl
+            loader.cancel()
+        loader.on_opened = on_opened
+        loader.on_progress = lambda *args: self.events.append(('progress',) + args)
+        loader.on_finished = lambda: self.events.append(('finished',))
+        loader.start()
+        loader.join()
+        self.assertEquals(self.events, [])
+        self.assertFalse(self.dl.is_loaded('graph'))
+
+    def test_close_while_parsing(self):
+        loader = DataLoaderThread(self.filename, [('graph',)])
+        parsing = Event()
+        # Make parsing the graph slow
+        def on_opened(dl):
+            self.dl = dl
+            load_graph = dl.load_graph
+            def slow_load_graph():
+                parsing.set()
+                time.sleep(1)
+                return load_graph()
+            dl.load_graph = slow_load_graph
+        loader.on_opened = on_opened
+        loader.start()
+        parsing.wait()
+        # Closing doesn't wait for the graph, but the thread closes the
+        # archive once it's parsed
+        start = time.time()
+        loader.close()
+        self.assertTrue(time.time() - start < 0.5, msg='close() waited')
+        loader.join()
+        self.assertTrue(self.dl.archive.fp is None, msg='Archive not closed')
+        # Once the thread has stopped, closing closes right away
+        loader = self.start_loader(self.filename, [('graph',)])
+        loader.join()
+        loader.close()
+        self.assertTrue(self.dl.archive.fp is None, msg='Archive not closed')
+
+    def test_error(self):
+        loader = self.start_loader(path.join(self.tmp_dir, 'missing.zip'),
+                                   [('graph',)])
+        loader.join()
+        self.assertEquals(len(self.events), 1)
+        self.assertEquals(self.events[0][0], 'error')
+
+    def tearDown(self):
+        """Cleans up after tests are run"""
+        if self.dl is not None:
+            self.dl.close()
+        shutil.rmtree(self.tmp_dir)
+
+
+suite = unittest.TestLoader().loadTestsFromTestCase(TestConcussDataLoader)
+suite = unittest.TestLoader().loadTestsFromTestCase(TestParsers)
+suite = unittest.TestLoader().loadTestsFromTestCase(TestColoringHistory)
+suite = unittest.TestLoader().loadTestsFromTestCase(TestDataLoaderThread)
+
+if __name__ == '__main__':
+    unittest.main()
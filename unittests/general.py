@@ -4,8 +4,13 @@
 # the three-clause BSD license; see LICENSE.
 #
 
+import math
 import unittest
-from beavr import util
+
+import networkx as nx
+import numpy as np
+
+from beavr import layout, util
 
 class TestUtil(unittest.TestCase):
 
@@ -73,7 +78,70 @@ class TestUtil(unittest.TestCase):
                             "\n  Expected: " + str(expected_mapped) +\
                             "\n  Actual:   " + str(actual_mapped))
 
+
+class TestLayout(unittest.TestCase):
+
+    def test_radial_layout(self):
+        # Vertex 3 is the root, with children 0 and 4; 0 has children 1 and 2
+        points = layout.radial_layout([3, 0, 0, -1, 3])
+        self.assertTrue(np.allclose(points[3], [0, 0]), msg='Root not centered')
+        radii = np.hypot(points[:, 0], points[:, 1])
+        self.assertTrue(np.allclose(radii, [1, 2, 2, 0, 1]),
+                msg='Radii are not depths')
+        angles = np.arctan2(points[:, 1], points[:, 0]) % (2 * math.pi)
+        # Vertex 0 has two leaves under it, so it gets two thirds of the
+        # circle, split between its children
+        self.assertTrue(np.allclose(angles[[0, 1, 2, 4]],
+                [2 * math.pi / 3, math.pi / 3, math.pi, 5 * math.pi / 3]),
+                msg='Wrong angles')
+
+    def test_radial_layout_forest(self):
+        # Every tree is laid out around the origin by itself
+        points = layout.radial_layout([-1, 0, -1, 2, 3])
+        self.assertTrue(np.allclose(points[[0, 2]], 0), msg='Roots moved')
+        self.assertTrue(np.allclose(np.hypot(points[:, 0], points[:, 1]),
+                [0, 1, 0, 1, 2]), msg='Radii are not depths')
+
+    def test_fit_layouts(self):
+        # A layout 4 wide and 2 high, one of a single vertex, and a vertical
+        # one
+        points = np.array([[0, 0], [4, 2], [2, 1], [7, 7], [1, 1], [1, 3]],
+                          dtype=float)
+        points = layout.fit_layouts(points, [3, 1, 2], 0.15)
+        scale = 0.5 - 0.15 - 0.005
+        self.assertTrue(np.allclose(points,
+                [[0.5 - scale, 0.5 - scale], [0.5 + scale, 0.5 + scale],
+                 [0.5, 0.5], [0.5, 0.5], [0.5, 0.5 - scale],
+                 [0.5, 0.5 + scale]]), msg='Wrong positions')
+
+    def test_tree_layouts(self):
+        layouts = layout.tree_layouts([{'a': None, 'b': 'a', 'c': 'a'},
+                                       {'a': None}], 0.15)
+        self.assertEquals([sorted(tree_layout) for tree_layout in layouts],
+                [['a', 'b', 'c'], ['a']], msg='Wrong vertices')
+        for tree_layout in layouts:
+            for x, y in tree_layout.itervalues():
+                self.assertTrue(0.15 <= x <= 0.85 and 0.15 <= y <= 0.85,
+                        msg='Position out of bounds')
+        self.assertEquals(layout.tree_layouts([], 0.15), [])
+
+    def test_digraph_parents(self):
+        self.assertEquals(layout.digraph_parents(
+                nx.DiGraph([(1, 0), (2, 0), (3, 2)])),
+                {0: None, 1: 0, 2: 0, 3: 2})
+
+    def test_shelf_pack(self):
+        boxes = layout.shelf_pack([1, 2, 1, 1], [1, 2, 1, 1])
+        # The tallest box fills the first shelf, and the rest go below it,
+        # two to a shelf
+        self.assertTrue(np.allclose(boxes,
+                [[0, -3, 1, -2], [0, -2, 2, 0], [1, -3, 2, -2], [0, -4, 1, -3]]),
+                msg='Wrong boxes')
+        self.assertEquals(layout.shelf_pack([], []).shape, (0, 4))
+
+
 suite = unittest.TestLoader().loadTestsFromTestCase(TestUtil)
+suite = unittest.TestLoader().loadTestsFromTestCase(TestLayout)
 
 if __name__ == '__main__':
     unittest.main()